@@ -2,384 +2,419 @@
 # author: Nick Taber / Pokebunny
 # version: 8/12/22
 
+import api
 import characters
+import event_log
+import leaderboards
+import match_history
+import metrics
+import notifications
+import shard
+import stat_store
+import stats
 
 import os
+import json
 import time
+import asyncio
 import logging
 from json import JSONDecodeError
 
-import requests
-
 import discord
-from discord import ButtonStyle
-from discord.ui import Button, View
-from discord.ext import commands, tasks
+from discord.ext import commands
 from dotenv import load_dotenv
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-
-# load .env file which has discord token
-load_dotenv()
-TOKEN = os.getenv("MMBOT_TOKEN")
 intents = discord.Intents.all()
 
 # initialize the bot commands with the associated prefix
 bot = commands.Bot(command_prefix="%", intents=intents, case_insensitive=True)
 
-# use creds to create a client to interact with the Google Drive API
-scope = ["https://spreadsheets.google.com/feeds",
-         "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name("client_secret.json", scope)
-client = gspread.authorize(creds)
-
-
-# Access spreadsheet and store data
-stars_off_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("STARS-OFF")
-stars_on_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("STARS-ON")
-off_log_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("Logs-OFF")
-on_log_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("Logs-ON")
-# Create a list of all player ratings (to be used for defining percentile search ranges)
-off_rating_list = sorted(list(map(int, stars_off_sheet.col_values(5)[1:])), reverse=True)
-on_rating_list = sorted(list(map(int, stars_on_sheet.col_values(5)[1:])), reverse=True)
-
-# Constant for starting percentile range for matchmaking search
-PERCENTILE_RANGE = 0.15
-# Constant to tell the bot where the matchmaking buttons appear
-BUTTON_CHANNEL_ID = 971164238888468520
-# Prod: 841761307245281320
-# Test: 971164238888468520
-
-# Constant to tell the bot where to post matchmaking updates
-MATCH_CHANNEL_ID = 971164132063727636
-# Prod: 948321928760918087
-# Test: 971164132063727636
-
-# The matchmaking queue
-queue = {}
-# The message with the matchmaking bot stuff
-mm_message = None
-
-mode_list = ["Superstars-Off Ranked", "Superstars-Off Unranked", "Superstars-On Ranked"]
+# How long each part of starting up took, in seconds
+startup_started = time.perf_counter()
+startup_timings = {}
+
+# Each community the bot runs matchmaking for. Every shard has its own buttons, match channel, ratings
+# spreadsheet, store and queue, and its own tasks, so one busy ladder can't hold up another (see shard.py)
+# storage_backend: "sqlite" keeps the ratings across restarts, "memory" doesn't
+# worker_process: run the shard's matchmaking engine in a process of its own (needs the sqlite backend)
+SHARDS = [
+    {"name": "mssb",
+     # Where the matchmaking buttons appear
+     # Prod: 841761307245281320
+     # Test: 971164238888468520
+     "button_channel_id": 971164238888468520,
+     # Where to post matchmaking updates
+     # Prod: 948321928760918087
+     # Test: 971164132063727636
+     "match_channel_id": 971164132063727636,
+     # Role pinged when someone has been waiting a while, for each mode
+     "role_ids": {"Superstars-Off Ranked": 998791156794150943, "Superstars-Off Unranked": 998791156794150943,
+                  "Superstars-On Ranked": 998791464630898808},
+     # The ratings spreadsheet, and the names of the STARS and Logs worksheets for each ladder
+     "spreadsheet_key": "1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc",
+     "ladder_worksheets": {"OFF": ("STARS-OFF", "Logs-OFF"), "ON": ("STARS-ON", "Logs-ON")},
+     # The columns of the player names and the ratings in the STARS worksheets
+     "stars_columns": (1, 5),
+     "storage_backend": "sqlite",
+     "ratings_db_path": "ratings.db",
+     "queue_journal_path": "queue_journal.jsonl",
+     # Pair up everyone who can be matched on each refresh, instead of stopping at the first match
+     "batch_pairing": True,
+     "worker_process": False},
+]
+# The running shards, set up by main()
+shards = []
+# Every shard's announcements, pings and DMs go out through here
+notifier = notifications.Notifier(bot)
+
+# Project Rio queries for ranked batting and pitching stats, narrowed down with &char_id= and &username=
+BATTING_STATS_URL = "https://api.projectrio.app/detailed_stats/?exclude_pitching=1&exclude_fielding=1&exclude_misc=1&tag=Normal&tag=Ranked"
+PITCHING_STATS_URL = "https://api.projectrio.app/detailed_stats/?exclude_batting=1&exclude_fielding=1&exclude_misc=1&tag=Normal&tag=Ranked"
+# Max number of user/character combinations in one stat command
+MAX_STAT_LOOKUPS = 20
+# Max number of requests at once when warming the Project Rio cache
+CACHE_WARM_CONCURRENCY = 4
+warm_task = None
+# Local copy of everyone's stats on every character, pulled from Project Rio in bulk and used to answer
+# stat lookups once it has been (see stat_store.py)
+STATS_DB_PATH = "stats.db"
+# Seconds between bulk pulls
+STATS_SYNC_INTERVAL = 900
+# Seconds since the last good pull after which lookups go back to asking Project Rio, so pulls failing
+# for days can't leave stale totals being served
+STATS_MAX_AGE = 4 * STATS_SYNC_INTERVAL
+# Added to the stats URLs to get totals for every user on every character in one response
+STATS_BULK_QUERY = "&by_user=1&by_char=1"
+local_stats = None
+sync_task = None
+# Best users on each character for each stat, rebuilt from local_stats after every pull
+leaderboard_tables = None
 
 # Initialize logging
-logging.basicConfig(filename="match_log.txt", level=logging.INFO)
-match_count = 1
+# Matches, queue events and errors go to match_log.jsonl as JSON lines, written from a background thread
+# Set MMBOT_LOG_LEVEL=DEBUG to also log every match check
+LOG_PATH = "match_log.jsonl"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+log_listener = None
+
+# Metrics for Prometheus, served at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv("MMBOT_METRICS_PORT", "9108"))
+queue_depth = metrics.Gauge("mmbot_queue_depth", "Players waiting in the queue", ("shard", "mode"),
+                            function=lambda: {(running.name, mode): running.queue.count(mode)
+                                              for running in shards for mode in running.modes})
+notification_backlog = metrics.Gauge("mmbot_notification_backlog", "Discord messages waiting to be sent",
+                                     function=lambda: {(): notifier.backlog()})
+rate_limit_waits = metrics.Counter("mmbot_discord_rate_limits_total", "Times Discord rate limited the bot")
+rate_limit_seconds = metrics.Counter("mmbot_discord_rate_limit_seconds_total",
+                                     "Seconds spent waiting out Discord rate limits")
+metrics_server = None
+
+
+# discord.py waits out rate limits by itself and only logs a warning, so count them from its log
+# Every 429 is logged as "... responded with 429. Retrying in %.2f seconds.", with the wait as the last
+# argument. Other messages mention the rate limit too (the global limit and "Done sleeping for the rate
+# limit"), but they're about a 429 that's already been counted
+RATE_LIMIT_MESSAGE = "responded with 429. Retrying in"
+
+
+class RateLimitCounter(logging.Handler):
+    def emit(self, record):
+        if RATE_LIMIT_MESSAGE in str(record.msg):
+            rate_limit_waits.inc()
+            if record.args and isinstance(record.args[-1], (int, float)):
+                rate_limit_seconds.inc(amount=record.args[-1])
 
 
 @bot.event
 async def on_ready():
     print(f"{bot.user} has connected to Discord!")
-    # Initialize matchmaking buttons
-    await init_buttons()
-
-    # Start timed tasks
-    refresh_queue.start()
-    refresh_api_data.start()
-
-
-async def init_buttons():
-    global mm_message
-    # Initialize matchmaking buttons
-
-    new_view = View(timeout=None)
-
-    for i in range(len(mode_list)):
-        button = Button(label=mode_list[i], style=ButtonStyle.blurple)
-
-        async def press(interaction, mode=mode_list[i]):
-            await interaction.response.defer()
-            await enter_queue(interaction, mode)
-            await interaction.followup.send("You have entered the " + mode + " queue.", ephemeral=True)
-
-        button.callback = press
-        new_view.add_item(button)
-
-    dequeue_button = Button(label="Leave Queue", style=ButtonStyle.red)
-
-    async def dequeue_press(interaction):
-        await interaction.response.defer()
-        await exit_queue(interaction)
-        await interaction.followup.send("You have left the matchmaking queue.", ephemeral=True)
-
-    dequeue_button.callback = dequeue_press
-
-    feedback_button = Button(label="Give Feedback", style=ButtonStyle.url, url="https://forms.gle/KNKwp86VFxrgkZiW9")
-
-    # button_view.add_item(stars_unranked_button)
-    new_view.add_item(dequeue_button)
-    new_view.add_item(feedback_button)
-    channel = bot.get_channel(BUTTON_CHANNEL_ID)
-    history = channel.history()
-    async for m in history:
-        if m.author == bot.user:
-            await m.delete()
-
-    mm_message = await channel.send("Matchmaking queue initialized! Press buttons below to search for a game.",
-                                    view=new_view)
-
-
-# Command for a player to enter the matchmaking queue
-# If they are in the queue already, it will refresh their presence in the queue
-# You can also move from one queue to another with this
-# @bot.command(name="queue", aliases=["q"], help="Enter queue")
-async def enter_queue(interaction, game_type="Superstars-Off Ranked"):
-    player_rating = 1400
-    player_id = str(interaction.user.id)
-    player_name = interaction.user.name
-    if game_type == "Superstars-On Ranked" or game_type == "Superstars-On Unranked":
-        # TODO: Avoid accessing the API every time someone queues
-        matches = on_log_sheet.findall(player_id)
-        if matches:
-            player_rating = round(float(on_log_sheet.cell(matches[-1].row, matches[-1].col + 3).value))
-    else:
-        # TODO: Avoid accessing the API every time someone queues
-        matches = off_log_sheet.findall(player_id)
-        if matches:
-            player_rating = round(float(off_log_sheet.cell(matches[-1].row, matches[-1].col + 3).value))
-
-    # put player in queue
-    queue[player_id] = {"Name": player_name, "Rating": player_rating, "Time": time.time(), "Game Type": game_type}
-
-    # calculate search range
-    min_rating, max_rating = calc_search_range(player_rating, game_type, PERCENTILE_RANGE)
-
-    # check for match
-    await check_for_match(player_id, min_rating, max_rating, 0)
-
-    await update_queue_status()
-
-
-# Command for a player to remove themselves from the queue
-# If they aren't in the queue, it will just post a message with the queue status
-# @bot.command(name="dequeue", aliases=["dq"], help="Exit queue")
-async def exit_queue(interaction):
-    if str(interaction.user.id) in queue:
-        del queue[str(interaction.user.id)]
-    await update_queue_status()
-
-
-@bot.command(name="ostat", help="Look up player batting stats on Project Rio")
+    global warm_task, sync_task, metrics_server
+    if warm_task is None:
+        startup_timings["connect to Discord"] = time.perf_counter() - startup_started
+        warm_task = asyncio.create_task(warm_stat_cache())
+        sync_task = asyncio.create_task(sync_stats())
+
+    notifier.start()
+    # Initialize matchmaking buttons and start each shard's tasks
+    for running in shards:
+        try:
+            await running.start()
+        except discord.HTTPException:
+            logging.exception("Couldn't start shard " + running.name)
+
+    if metrics_server is None:
+        try:
+            metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError:
+            logging.exception("Couldn't start the metrics server")
+            metrics_server = False
+
+
+@bot.command(name="ostat", help="Look up player batting stats on Project Rio. Separate users or characters with "
+                               "commas to compare several at once")
 async def o_stat(ctx, user="all", char="all"):
-    url = "https://api.projectrio.app/detailed_stats/?exclude_pitching=1&exclude_fielding=1&exclude_misc=1&tag=Normal&tag=Ranked"
-    all_url = url
-
     try:
-        if char.lower() in characters.aliases:
-            char = characters.mappings[characters.aliases[char.lower()]]
-        if char != "all":
-            url += "&char_id=" + str(characters.reverse_mappings[char])
-            if user != "all":
-                all_url = url
-
-        if user != "all":
-            url += "&username=" + user
-
-        all_response = requests.get(all_url).json()
-        response = requests.get(url).json()
-
-        stats = response["Stats"]["Batting"]
-        pa = stats["summary_at_bats"] + stats["summary_walks_bb"] + stats["summary_walks_hbp"] + stats[
-            "summary_sac_flys"]
-        avg = stats["summary_hits"] / stats["summary_at_bats"]
-        obp = (stats["summary_hits"] + stats["summary_walks_hbp"] + stats["summary_walks_bb"]) / pa
-        slg = (stats["summary_singles"] + (stats["summary_doubles"] * 2) + (stats["summary_triples"] * 3) + (
-                stats["summary_homeruns"] * 4)) / stats["summary_at_bats"]
-        ops = obp + slg
-        # pa = stats["plate_appearances"]
-
-        overall = all_response["Stats"]["Batting"]
-        overall_pa = overall["summary_at_bats"] + overall["summary_walks_bb"] + overall["summary_walks_hbp"] + overall[
-            "summary_sac_flys"]
-        overall_obp = (overall["summary_hits"] + overall["summary_walks_hbp"] + overall[
-            "summary_walks_bb"]) / overall_pa
-        overall_slg = (overall["summary_singles"] + (overall["summary_doubles"] * 2) + (
-                overall["summary_triples"] * 3) + (
-                               overall["summary_homeruns"] * 4)) / overall["summary_at_bats"]
-
-        ops_plus = ((obp / overall_obp) + (slg / overall_slg) - 1) * 100
-
-        c_o = " cOPS+"
-        if char == "all" or user == "all":
-            c_o = " OPS+"
-
-        embed = discord.Embed(title=user + " - " + char + " (" + str(pa) + " PA): ", description="AVG: " + "{:.3f}".format(avg) + "\nOBP: " + "{:.3f}".format(
-            obp) + "\nSLG: " + "{:.3f}".format(slg) + "\nOPS: " + "{:.3f}".format(ops) + "\n" + c_o + ": " + str(round(ops_plus)))
-
-        embed.set_thumbnail(url=characters.images[char])
+        lookups = stat_lookups(BATTING_STATS_URL, user, char)
+        if len(lookups) > MAX_STAT_LOOKUPS:
+            await ctx.send("Too many lookups, the limit is " + str(MAX_STAT_LOOKUPS))
+            return
+        responses = await fetch_stat_lookups(lookups, "Batting")
+
+        if len(lookups) == 1:
+            user, char = lookups[0][:2]
+            line = stats.batting_line(*responses[0])
+
+            c_o = " cOPS+"
+            if char == "all" or user == "all":
+                c_o = " OPS+"
+
+            embed = discord.Embed(title=user + " - " + char + " (" + str(line["pa"]) + " PA): ", description="AVG: " + "{:.3f}".format(line["avg"]) + "\nOBP: " + "{:.3f}".format(
+                line["obp"]) + "\nSLG: " + "{:.3f}".format(line["slg"]) + "\nOPS: " + "{:.3f}".format(line["ops"]) + "\n" + c_o + ": " + str(round(line["ops_plus"])))
+
+            embed.set_thumbnail(url=characters.images[char])
+        else:
+            rows = []
+            for (user, char, char_id, all_url, url), response in zip(lookups, responses):
+                try:
+                    line = stats.batting_line(*response)
+                    rows.append([user, char, str(line["pa"]), "{:.3f}".format(line["avg"]), "{:.3f}".format(line["obp"]),
+                                 "{:.3f}".format(line["slg"]), "{:.3f}".format(line["ops"]), str(round(line["ops_plus"]))])
+                except (KeyError, ZeroDivisionError):
+                    rows.append([user, char, "-", "-", "-", "-", "-", "-"])
+            embed = discord.Embed(title="Batting stats (OPS+ is cOPS+ for a user on one character)",
+                                  description=stat_table(["User", "Char", "PA", "AVG", "OBP", "SLG", "OPS", "OPS+"], rows))
 
         await ctx.send(embed=embed)
     except JSONDecodeError:
         await ctx.send("JSON Error")
+    except characters.UnknownCharacter as error:
+        await ctx.send(unknown_character_message(error))
     except KeyError:
         await ctx.send("Key Error")
+    except api.NETWORK_ERRORS:
+        await ctx.send("Connection Error")
 
 
-@bot.command(name="pstat", help="Look up player pitching stats on Project Rio")
+@bot.command(name="pstat", help="Look up player pitching stats on Project Rio. Separate users or characters with "
+                               "commas to compare several at once")
 async def p_stat(ctx, user="all", char="all"):
-    url = "https://api.projectrio.app/detailed_stats/?exclude_batting=1&exclude_fielding=1&exclude_misc=1&tag=Normal&tag=Ranked"
-    all_url = url
-
     try:
-        if char.lower() in characters.aliases:
-            char = characters.mappings[characters.aliases[char.lower()]]
-        if char != "all":
-            url += "&char_id=" + str(characters.reverse_mappings[char])
-            if user != "all":
-                all_url = url
-
-        if user != "all":
-            url += "&username=" + user
-
-        all_response = requests.get(all_url).json()
-        response = requests.get(url).json()
-
-        stats = response["Stats"]["Pitching"]
-
-        # batter avg vs pitcher
-        d_avg = stats["hits_allowed"] / (stats["batters_faced"] - stats["walks_bb"] - stats["walks_hbp"])
-        era = 9 * stats["runs_allowed"] / (stats["outs_pitched"] / 3)
-        # strikeout percentage
-        kp = (stats["strikeouts_pitched"] / stats["batters_faced"]) * 100
-
-        ip = stats["outs_pitched"] // 3
-        ip_str = str(ip + (0.1 * (stats["outs_pitched"] % 3)))
-
-        overall = all_response["Stats"]["Pitching"]
-        overall_era = 9 * overall["runs_allowed"] / (overall["outs_pitched"] / 3)
-        # character ERA-
-        cera_minus = (era / overall_era) * 100
-
-        char_or_all = " cERA-"
-        if char == "all" or user == "all":
-            char_or_all = " ERA-"
-
-        embed = discord.Embed(title=user + " - " + char + " (" + ip_str + " IP): ",
-                              description="opp. AVG: " + "{:.3f}".format(d_avg) + "\nERA: " + "{:.2f}".format(era) +
-                                          "\nK%: " + "{:.1f}".format(kp) + "\n" + char_or_all + ": " + str(round(cera_minus)))
-
-        embed.set_thumbnail(url=characters.images[char])
+        lookups = stat_lookups(PITCHING_STATS_URL, user, char)
+        if len(lookups) > MAX_STAT_LOOKUPS:
+            await ctx.send("Too many lookups, the limit is " + str(MAX_STAT_LOOKUPS))
+            return
+        responses = await fetch_stat_lookups(lookups, "Pitching")
+
+        if len(lookups) == 1:
+            user, char = lookups[0][:2]
+            line = stats.pitching_line(*responses[0])
+
+            char_or_all = " cERA-"
+            if char == "all" or user == "all":
+                char_or_all = " ERA-"
+
+            embed = discord.Embed(title=user + " - " + char + " (" + line["ip"] + " IP): ",
+                                  description="opp. AVG: " + "{:.3f}".format(line["d_avg"]) + "\nERA: " + "{:.2f}".format(line["era"]) +
+                                              "\nK%: " + "{:.1f}".format(line["kp"]) + "\n" + char_or_all + ": " + str(round(line["era_minus"])))
+
+            embed.set_thumbnail(url=characters.images[char])
+        else:
+            rows = []
+            for (user, char, char_id, all_url, url), response in zip(lookups, responses):
+                try:
+                    line = stats.pitching_line(*response)
+                    rows.append([user, char, line["ip"], "{:.3f}".format(line["d_avg"]), "{:.2f}".format(line["era"]),
+                                 "{:.1f}".format(line["kp"]), str(round(line["era_minus"]))])
+                except (KeyError, ZeroDivisionError):
+                    rows.append([user, char, "-", "-", "-", "-", "-"])
+            embed = discord.Embed(title="Pitching stats (ERA- is cERA- for a user on one character)",
+                                  description=stat_table(["User", "Char", "IP", "oAVG", "ERA", "K%", "ERA-"], rows))
 
         await ctx.send(embed=embed)
     except JSONDecodeError:
         await ctx.send("JSON Error")
+    except characters.UnknownCharacter as error:
+        await ctx.send(unknown_character_message(error))
     except KeyError:
         await ctx.send("Key Error")
+    except api.NETWORK_ERRORS:
+        await ctx.send("Connection Error")
+
+
+# Works out the Project Rio queries for a stat command
+# users and chars can be comma separated lists, and every user is looked up on every character
+# Characters can be given by name or alias, and close misspellings are corrected
+# return: list of (user, character name, char_id, league url, player url)
+def stat_lookups(base_url, users, chars):
+    lookups = []
+    # Every character is resolved before anything is fetched, so a typo doesn't cost any requests
+    for character in [characters.resolve(char) for char in chars.split(",")]:
+        for user in users.split(","):
+            url = base_url
+            all_url = url
+            if character is not characters.ALL:
+                url += "&char_id=" + str(character.char_id)
+                if user != "all":
+                    all_url = url
+
+            if user != "all":
+                url += "&username=" + user
+            lookups.append((user, character.name, character.char_id, all_url, url))
+    return lookups
+
+
+# What to tell someone who asked for a character that couldn't be found
+def unknown_character_message(error):
+    message = "Unknown character " + error.name
+    if error.suggestions:
+        message += ", did you mean " + " or ".join(error.suggestions) + "?"
+    return message
+
+
+# Sends every query for a list of stat lookups at once. League urls shared between lookups
+# are only fetched once. While the local stat store has a recent pull the lookups are answered from it instead
+# return: list of (player stats, league stats) for the given kind of stats ("Batting" or "Pitching")
+async def fetch_stat_lookups(lookups, kind):
+    synced = local_stats.synced(kind)
+    if synced is not None and time.time() - synced < STATS_MAX_AGE:
+        # League stats are for the lookup's character when it's one user on one character, like all_url
+        return [(local_stats.totals(kind, None if user == "all" else user, char_id),
+                 local_stats.totals(kind, None, None if user == "all" else char_id))
+                for user, char, char_id, all_url, url in lookups]
+
+    urls = list(dict.fromkeys(url for lookup in lookups for url in lookup[3:]))
+    responses = dict(zip(urls, await asyncio.gather(*[api.get_rio(url) for url in urls])))
+    # Missing stats come back empty, so the stat line calculation raises a KeyError for that lookup only
+    return [(responses[url].get("Stats", {}).get(kind, {}), responses[all_url].get("Stats", {}).get(kind, {}))
+            for user, char, char_id, all_url, url in lookups]
+
+
+# Pull everyone's totals on every character from Project Rio into the local stat store, every STATS_SYNC_INTERVAL
+# Decoding and storing a pull and rebuilding the leaderboards are big jobs, so they run off the event loop
+async def sync_stats():
+    while True:
+        for kind, base_url in (("Batting", BATTING_STATS_URL), ("Pitching", PITCHING_STATS_URL)):
+            try:
+                text = await api.get_text(base_url + STATS_BULK_QUERY, api.RIO_BULK_TIMEOUT)
+                await asyncio.to_thread(
+                    lambda: local_stats.replace(kind, stat_store.parse_grouped_stats(json.loads(text), kind)))
+            except Exception:
+                # Keep pulling whatever went wrong, a bad payload included
+                logging.exception("Couldn't pull " + kind + " stats from Project Rio")
+            try:
+                # Also builds the leaderboards from the last pull when the bot starts, even if this pull failed
+                if local_stats.synced(kind):
+                    await asyncio.to_thread(leaderboard_tables.refresh, kind)
+            except Exception:
+                logging.exception("Couldn't rebuild the " + kind + " leaderboards")
+        await asyncio.sleep(STATS_SYNC_INTERVAL)
 
 
-# refresh to see if a match can now be created with players waiting in the queue
-@tasks.loop(seconds=15)
-async def refresh_queue():
-    for player in queue:
-        time_in_queue = time.time() - queue[player]["Time"]
-        new_range = PERCENTILE_RANGE + (PERCENTILE_RANGE * time_in_queue / 180)
-        min_rating, max_rating = calc_search_range(queue[player]["Rating"], queue[player]["Game Type"], new_range)
-        if await check_for_match(player, min_rating, max_rating, 120):
-            await update_queue_status()
-            break
-
-
-# update spreadsheet API data once per minute
-@tasks.loop(minutes=1)
-async def refresh_api_data():
-    global stars_off_sheet, stars_on_sheet, off_log_sheet, on_log_sheet, off_rating_list, on_rating_list
-    stars_off_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("STARS-OFF")
-    stars_on_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("STARS-ON")
-    off_log_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("Logs-OFF")
-    on_log_sheet = client.open_by_key("1B03IEnfOo3pAG7wBIjDW6jIHP0CTzn7jQJuxlNJebgc").worksheet("Logs-ON")
-    off_rating_list = sorted(list(map(int, stars_off_sheet.col_values(5)[1:])), reverse=True)
-    on_rating_list = sorted(list(map(int, stars_on_sheet.col_values(5)[1:])), reverse=True)
-
-
-# Update message with the current queue status
-async def update_queue_status():
-    global mm_message
-    queue_numbers = {}
-    for mode in mode_list:
-        queue_numbers[mode] = 0
-    for user in queue:
-        queue_numbers[queue[user]["Game Type"]] += 1
-
-    new_message = "There are " + str(len(queue)) + " users in the matchmaking queue ("
-    for mode in mode_list:
-        new_message += str(queue_numbers[mode]) + " " + mode + ", "
-    new_message = new_message[:-2] + ")"
-    # print(queue)
-    await mm_message.edit(content=new_message)
-
-
-# params: player's rating and what percentile you want your search range to cover
-# return: min and max rating the player can match against
-def calc_search_range(rating, game_type, percentile):
-    if game_type == "Superstars-On Ranked" or game_type == "Superstars-On Unranked":
-        rating_list_copy = on_rating_list.copy()
+@bot.command(name="leaderboard", help="Show the best users on a character (or all) for a stat: " +
+                                     ", ".join(leaderboards.LEADERBOARD_STATS))
+async def leaderboard(ctx, char="all", stat="ops+"):
+    try:
+        character = characters.resolve(char)
+    except characters.UnknownCharacter as error:
+        await ctx.send(unknown_character_message(error))
+        return
+    stat = stat.lower()
+    if stat not in leaderboards.LEADERBOARD_STATS:
+        await ctx.send("Unknown stat " + stat + ", choose from " + ", ".join(leaderboards.LEADERBOARD_STATS))
+        return
+
+    kind, key, higher_is_better, number_format, header = leaderboards.LEADERBOARD_STATS[stat]
+    table = leaderboard_tables.top(character.char_id, stat)
+    if not table:
+        await ctx.send("No one qualifies for that leaderboard yet")
+        return
+    if character is not characters.ALL and stat in ("ops+", "era-"):
+        header = "c" + header
+    if kind == "Batting":
+        sample_header, minimum = "PA", str(leaderboards.MIN_PA)
     else:
-        rating_list_copy = off_rating_list.copy()
-    if game_type != "Superstars-Off Ranked":
-        percentile = percentile * 2
-    rating_list_copy.append(rating)
-    rating_list_copy.append(0)
-    rating_list_copy.append(3000)
-    pct_list = sorted(rating_list_copy, reverse=True)
-    max_index = round(pct_list.index(rating) - (len(pct_list) * percentile))
-    min_index = round(pct_list.index(rating) + (len(pct_list) * percentile))
-    if max_index < 0:
-        max_index = 0
-    if min_index >= len(pct_list):
-        min_index = len(pct_list) - 1
-
-    max_rating = pct_list[max_index]
-    min_rating = pct_list[min_index]
-
-    return min_rating, max_rating
-
-
-# Checks if there is an available match for a user.
-# Uses their user_id, search range (min-max ratings), and the min time an opponent must be searching to be matched.
-async def check_for_match(user_id, min_rating, max_rating, min_time):
-    print("Player:", queue[user_id]["Name"], "Rating:", queue[user_id]["Rating"], "Time:",
-          round(time.time() - queue[user_id]["Time"]), "Rating Range", min_rating, max_rating)
-    channel = bot.get_channel(MATCH_CHANNEL_ID)
-    if len(queue) >= 2:
-        best_match = False
-        for player in queue:
-            if max_rating >= queue[player]["Rating"] >= min_rating and \
-                    player != user_id and time.time() - queue[player]["Time"] > min_time and \
-                    queue[player]["Game Type"] == queue[user_id]["Game Type"]:
-                if not best_match or abs(queue[best_match]["Rating"] - queue[user_id]["Rating"]) > abs(
-                        queue[player]["Rating"] - queue[user_id]["Rating"]):
-                    best_match = player
-
-        if best_match:
-            global match_count
-            await channel.send("We have a " + queue[user_id][
-                "Game Type"] + " match! <@" + user_id + "> vs <@" + str(best_match) + ">. Find matches in <#" + str(BUTTON_CHANNEL_ID) + ">")
+        sample_header, minimum = "IP", str(leaderboards.MIN_OUTS_PITCHED // 3)
+    rows = [[str(place), user, number_format.format(value), sample]
+            for place, (user, value, sample) in enumerate(table, 1)]
+    embed = discord.Embed(title=header + " leaders - " + character.name + " (min " + minimum + " " + sample_header + ")",
+                          description=stat_table(["#", "User", header, sample_header], rows))
+    embed.set_thumbnail(url=character.image)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="matchreport", help="Report on every match logged: matches per hour, rating gaps, waits and "
+                                     "how many players gave up")
+async def match_report(ctx):
+    # Reading years of logs takes a while, so it's done off the event loop
+    report = await asyncio.to_thread(
+        lambda: match_history.summarize(match_history.read_records(match_history.log_paths(LOG_PATH))).report())
+    rows = [[mode, str(report["matches_by_mode"][mode]), str(report["matches_per_hour"].get(mode, "-"))]
+            for mode in report["matches_by_mode"]]
+    embed = discord.Embed(title="Matchmaking report (" + str(report["matches"]) + " matches, " +
+                                "{:.0f}".format(report["hours_logged"]) + " hours with times)",
+                          description=stat_table(["Mode", "Matches", "Per hour"], rows) +
+                                      "Rating gap: median <=" + str(report["gap_p50"]) + ", 90% <=" +
+                                      str(report["gap_p90"]) + "\nWait: median <=" + str(report["wait_p50"]) +
+                                      "s, 90% <=" + str(report["wait_p90"]) + "s, 99% <=" + str(report["wait_p99"]) +
+                                      "s\nGave up waiting: " + str(report["left_unmatched"]) + " (" +
+                                      "{:.1%}".format(report["abandonment_rate"]) + ")")
+    await ctx.send(embed=embed)
+
+
+# Lines up rows of text in columns, in a code block so it shows up monospaced
+def stat_table(headers, rows):
+    widths = [max(len(row[col]) for row in [headers] + rows) for col in range(len(headers))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in [headers] + rows]
+    return "```\n" + "\n".join(lines) + "\n```"
+
+
+@bot.command(name="cachestats", help="Show how often stat lookups are answered from the cache")
+async def cache_stats(ctx):
+    counts = api.rio_cache.stats()
+    await ctx.send(", ".join(name + ": " + str(counts[name]) for name in counts))
+
+
+# Fetch the league-wide stats every %ostat/%pstat lookup is compared against, for every character, so
+# most lookups only need to fetch the player's own stats
+async def warm_stat_cache():
+    urls = []
+    for base_url in (BATTING_STATS_URL, PITCHING_STATS_URL):
+        urls.append(base_url)
+        for char_id in characters.mappings:
+            if char_id is not None:
+                urls.append(base_url + "&char_id=" + str(char_id))
+
+    limit = asyncio.Semaphore(CACHE_WARM_CONCURRENCY)
+
+    async def warm(url):
+        async with limit:
             try:
-                logging.info(str(match_count) + " " + queue[user_id]["Game Type"] + " match: " + queue[user_id][
-                    "Name"] + " " + str(queue[user_id]["Rating"]) + " vs " + queue[best_match]["Name"] + " " + str(
-                    queue[best_match]["Rating"]))
-            except KeyError:
-                print("Double match")
-            match_count += 1
-            if best_match in queue:
-                del queue[best_match]
-            if user_id in queue:
-                del queue[user_id]
-            return True
-
-    if 300 < time.time() - queue[user_id]["Time"] < 315:
-        role_id = "<@&998791156794150943>"
-        if queue[user_id]["Game Type"] == "Superstars-On Ranked":
-            role_id = "<@&998791464630898808>"
-        await channel.send("There is a player looking for a match in queue! " + role_id)
-
-    if 900 < time.time() - queue[user_id]["Time"] < 915:
-        user = await bot.fetch_user(user_id)
-        await user.send("You have been in the queue for 15 minutes. Please leave the queue if you have found a match or are no longer looking.")
-
-    return False
-
-
-# run the bot
-bot.run(TOKEN)
+                await api.get_rio(url)
+            except (JSONDecodeError, *api.NETWORK_ERRORS):
+                pass
+
+    await asyncio.gather(*[warm(url) for url in urls])
+    print("Stat cache warmed:", api.rio_cache.stats())
+
+
+def main():
+    global log_listener, local_stats, leaderboard_tables
+    # load .env file which has discord token
+    load_dotenv()
+    log_listener = event_log.setup(LOG_PATH, os.getenv("MMBOT_LOG_LEVEL", "INFO"), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    logging.getLogger("discord.http").addHandler(RateLimitCounter(logging.WARNING))
+    local_stats = stat_store.StatStore(STATS_DB_PATH)
+    leaderboard_tables = leaderboards.Leaderboards(local_stats)
+    shards.extend(shard.Shard(bot, notifier, config, startup_timings) for config in SHARDS)
+
+    # run the bot
+    bot.run(os.getenv("MMBOT_TOKEN"))
+    for running in shards:
+        running.stop()
+    log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# file: api.py
+# Network calls to Google Sheets and Project Rio, run so they never block the bot's event loop
+# gspread is blocking, so its calls go to a small thread pool. Project Rio is called with aiohttp
+# (which discord.py already depends on) through one shared session
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import aiohttp
+
+import metrics
+
+# Max number of Sheets calls running at once
+SHEETS_WORKERS = 4
+# Seconds to wait on a single call before giving up
+SHEETS_TIMEOUT = 30
+RIO_TIMEOUT = 15
+# Seconds to wait on a bulk pull of everyone's stats, which is a much bigger response than a single lookup
+RIO_BULK_TIMEOUT = 300
+# Seconds a Project Rio response is served from the cache, and for how long after that a stale copy
+# is still served while a fresh one is fetched in the background
+RIO_CACHE_TTL = 600
+RIO_CACHE_STALE_TTL = 3600
+# Max number of Project Rio responses kept
+RIO_CACHE_SIZE = 1024
+
+# Errors a Project Rio lookup can fail with (besides bad JSON)
+NETWORK_ERRORS = (asyncio.TimeoutError, aiohttp.ClientError)
+
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+rio_session = None
+
+# Work currently waiting on each service ("sheets" or "rio"), running totals and how long calls take
+in_flight = metrics.Gauge("mmbot_external_calls_in_flight", "Calls currently waiting on an external service",
+                          ("service",))
+call_counts = metrics.Counter("mmbot_external_calls_total", "Calls made to an external service", ("service",))
+error_counts = metrics.Counter("mmbot_external_call_errors_total", "Calls to an external service that failed",
+                               ("service",))
+call_seconds = metrics.Histogram("mmbot_external_call_seconds", "Time taken by calls to an external service",
+                                 ("service",))
+
+
+# Run a blocking gspread call on the Sheets thread pool
+async def run_sheets(func, *args):
+    return await wait_sheets(sheets_executor.submit(func, *args))
+
+
+# Wait for a call already submitted to the Sheets thread pool, giving up after SHEETS_TIMEOUT
+# A call can't be stopped once it's running, so it may still finish after this has given up,
+# and callers that need to know when it has can hold on to its future
+async def wait_sheets(future):
+    call_counts.inc("sheets")
+    in_flight.inc("sheets")
+    try:
+        with call_seconds.time("sheets"):
+            return await asyncio.wait_for(asyncio.wrap_future(future), SHEETS_TIMEOUT)
+    except Exception:
+        error_counts.inc("sheets")
+        raise
+    finally:
+        in_flight.inc("sheets", amount=-1)
+
+
+# GET a Project Rio API url and return the decoded JSON
+async def get_json(url):
+    return json.loads(await get_text(url))
+
+
+# GET a Project Rio API url and return the body undecoded, so a big response can be decoded off the event loop
+# timeout: seconds to give the whole request
+async def get_text(url, timeout=RIO_TIMEOUT):
+    global rio_session
+    if rio_session is None or rio_session.closed:
+        rio_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=RIO_TIMEOUT))
+
+    call_counts.inc("rio")
+    in_flight.inc("rio")
+    try:
+        with call_seconds.time("rio"):
+            async with rio_session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                return await response.text()
+    except Exception:
+        error_counts.inc("rio")
+        raise
+    finally:
+        in_flight.inc("rio", amount=-1)
+
+
+# Same URL with its query parameters in a fixed order, so equivalent lookups share a cache entry
+def normalize_url(url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+
+# Bounded LRU cache of responses by URL, with a TTL and stale-while-revalidate
+# Lookups for a URL that is already being fetched wait on that fetch instead of starting another
+class ResponseCache:
+    def __init__(self, fetch, max_size, ttl, stale_ttl):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # url -> (time fetched, response), least recently used first
+        self.entries = OrderedDict()
+        # url -> task fetching it
+        self.pending = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def get(self, url):
+        url = normalize_url(url)
+        cached = self.entries.get(url)
+        if cached is not None:
+            age = time.monotonic() - cached[0]
+            if age < self.ttl + self.stale_ttl:
+                self.entries.move_to_end(url)
+                if age < self.ttl:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    self.refresh(url)
+                return cached[1]
+
+        self.misses += 1
+        # Shielded so one caller giving up doesn't cancel the fetch for everyone else waiting on it
+        return await asyncio.shield(self.refresh(url))
+
+    # Start fetching a URL unless it's already being fetched
+    # return: the task fetching it
+    def refresh(self, url):
+        task = self.pending.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self.load(url))
+            # Nobody may be waiting on a background refresh, so don't leave its errors unretrieved
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.pending[url] = task
+        return task
+
+    async def load(self, url):
+        try:
+            response = await self.fetch(url)
+        finally:
+            del self.pending[url]
+        self.entries[url] = (time.monotonic(), response)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return response
+
+    def stats(self):
+        return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+                "size": len(self.entries), "in_flight": len(self.pending)}
+
+
+rio_cache = ResponseCache(get_json, RIO_CACHE_SIZE, RIO_CACHE_TTL, RIO_CACHE_STALE_TTL)
+rio_cache_metrics = metrics.Gauge("mmbot_rio_cache", "Project Rio response cache hits, misses and size", ("stat",),
+                                  function=lambda: {(stat,): value for stat, value in rio_cache.stats().items()})
+
+
+# GET a Project Rio API url through the response cache
+async def get_rio(url):
+    return await rio_cache.get(url)
@@ -1,3 +1,6 @@
+import sys
+from bisect import bisect_left
+
 # Character ID mappings
 mappings = {
     0: "Mario",
@@ -380,3 +383,98 @@ images = {
     "Bro(B)": "https://i.imgur.com/9oBKUlT.png",
     "all": "https://i.imgur.com/RTCrAYi.png"
 }
+
+
+# Everything the bot knows about a character in one place
+class Character:
+    __slots__ = ("char_id", "name", "image")
+
+    def __init__(self, char_id, name, image):
+        self.char_id = char_id
+        self.name = name
+        self.image = image
+
+
+# A character name that couldn't be resolved, with the closest names to suggest instead
+class UnknownCharacter(KeyError):
+    def __init__(self, name, suggestions):
+        super().__init__(name)
+        self.name = name
+        self.suggestions = suggestions
+
+
+# Lower case with everything but letters and digits taken out, so "Koopa(G)", "koopa g" and "KoopaG" all match
+def normalize(name):
+    return sys.intern("".join(c for c in name.lower() if c.isalnum()))
+
+
+# Overlapping three letter pieces of a normalized name, with its ends marked so they count for more
+def trigrams(key):
+    padded = "^" + key + "$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Stands for every character at once in the stat commands
+ALL = Character(None, "all", images["all"])
+# char_id -> Character
+table = {char_id: Character(char_id, mappings[char_id], images[mappings[char_id]])
+         for char_id in mappings if char_id is not None}
+
+# normalized alias or name -> Character
+alias_index = {normalize(alias): table[aliases[alias]] for alias in aliases}
+alias_index.update((normalize(character.name), character) for character in table.values())
+alias_index[normalize(ALL.name)] = ALL
+# Every key of alias_index, sorted so the keys starting with a prefix are next to each other
+sorted_keys = sorted(alias_index)
+# trigram -> keys of alias_index containing it
+trigram_index = {}
+for key in alias_index:
+    for gram in trigrams(key):
+        trigram_index.setdefault(gram, []).append(key)
+
+# Smallest similarity (from 0 to 1) for a typo to be taken as a character without asking
+FUZZY_MATCH_SCORE = 0.6
+# Number of names suggested for an unknown character, and the smallest similarity worth suggesting
+MAX_SUGGESTIONS = 3
+MIN_SUGGESTION_SCORE = 0.3
+
+
+# Find a character from a name or alias: an exact match, or else the only character with aliases
+# starting with it, or else a close enough spelling
+# return: the Character (ALL for "all")
+# raises: UnknownCharacter if nothing matches well enough
+def resolve(name):
+    key = normalize(name)
+    if key in alias_index:
+        return alias_index[key]
+
+    if key:
+        start = bisect_left(sorted_keys, key)
+        end = bisect_left(sorted_keys, key + "\x7f")
+        prefixed = {alias_index[sorted_keys[i]] for i in range(start, end)}
+        if len(prefixed) == 1:
+            return prefixed.pop()
+
+    matches = fuzzy_matches(key)
+    if matches and matches[0][0] >= FUZZY_MATCH_SCORE and (len(matches) == 1 or matches[1][0] < matches[0][0]):
+        return matches[0][1]
+    raise UnknownCharacter(name, [character.name for score, character in matches[:MAX_SUGGESTIONS]
+                                  if score >= MIN_SUGGESTION_SCORE])
+
+
+# Characters with an alias spelled like key, by how many trigrams they share (Dice coefficient)
+# return: list of (score, Character), best first and one entry per character
+def fuzzy_matches(key):
+    grams = trigrams(key)
+    shared = {}
+    for gram in grams:
+        for alias in trigram_index.get(gram, ()):
+            shared[alias] = shared.get(alias, 0) + 1
+
+    best = {}
+    for alias in shared:
+        score = 2 * shared[alias] / (len(grams) + len(trigrams(alias)))
+        character = alias_index[alias]
+        if score > best.get(character, 0):
+            best[character] = score
+    return sorted(((best[character], character) for character in best), key=lambda match: -match[0])
@@ -0,0 +1,95 @@
+# file: engine_worker.py
+# Runs a shard's matchmaking engine in a process of its own, for when one event loop can't keep up
+# with every shard's refreshes. Calls go to the worker over a pipe and the engine's events come
+# back the same way. The bot keeps a copy of the queue in step with those events, so the queue
+# status and the journal never have to ask the worker
+# The worker reads player ratings from the shard's SQLite store itself, and is sent the changes to
+# each ladder's players whose rating changed whenever the spreadsheet is re-read
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import matchmaking_engine
+import ratings
+import storage
+
+# Engine methods whose results are lists of events
+EVENT_METHODS = ("join", "leave", "refresh")
+
+
+# The worker process: build the engine, then answer calls until told to stop
+# Each reply is (True, result), or (False, exception) if the call raised
+def serve(connection, modes, batch_pairing, ratings_db_path, ladder_players, default_rating, engine_settings, entries):
+    rating_store = storage.open_store("sqlite", ratings_db_path)
+    percentile_engines = {ladder: ratings.PercentileEngine(ladder_players[ladder]) for ladder in ladder_players}
+    engine = matchmaking_engine.MatchmakingEngine(
+        matchmaking_engine.LadderRatings(rating_store, percentile_engines, default_rating),
+        modes=modes, batch_pairing=batch_pairing, **engine_settings)
+    for entry in entries:
+        engine.queue.add(entry)
+
+    while True:
+        method, args = connection.recv()
+        if method == "stop":
+            break
+        try:
+            if method == "apply_ladder_changes":
+                percentile_engines[args[0]].apply_changes(args[1])
+                result = None
+            else:
+                result = getattr(engine, method)(*args)
+        except Exception as error:
+            connection.send((False, error))
+        else:
+            connection.send((True, result))
+
+
+class EngineWorker:
+    # queue: the bot's copy of the queue, which the worker's engine starts from
+    # engine_settings: any other keyword arguments for the engine
+    def __init__(self, queue, batch_pairing, ratings_db_path, ladder_players, default_rating, engine_settings):
+        self.queue = queue
+        self.connection, worker_connection = multiprocessing.Pipe()
+        # spawn, so the worker doesn't inherit the bot's event loop and open connections
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=serve, daemon=True,
+            args=(worker_connection, list(queue.ratings), batch_pairing, ratings_db_path, ladder_players,
+                  default_rating, engine_settings, [queue[player_id] for player_id in queue]))
+        self.process.start()
+        # Calls wait on the pipe here instead of on the event loop, one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-worker")
+
+    # Call an engine method in the worker
+    async def call(self, method, *args):
+        result = await asyncio.get_running_loop().run_in_executor(self.executor, self.round_trip, method, args)
+        if method in EVENT_METHODS:
+            self.apply(result)
+        return result
+
+    def round_trip(self, method, args):
+        self.connection.send((method, args))
+        succeeded, result = self.connection.recv()
+        if not succeeded:
+            raise result
+        return result
+
+    # Make the same changes to the bot's copy of the queue that the engine made to its own
+    def apply(self, events):
+        for event in events:
+            if isinstance(event, matchmaking_engine.Joined):
+                self.queue.add(event.entry)
+            elif isinstance(event, matchmaking_engine.Left):
+                self.queue.remove(event.entry.player_id)
+            elif isinstance(event, matchmaking_engine.Matched):
+                for entry, opponent in event.matches:
+                    self.queue.remove(entry.player_id)
+                    self.queue.remove(opponent.player_id)
+            elif isinstance(event, matchmaking_engine.Reminder):
+                if event.entry.player_id in self.queue:
+                    self.queue[event.entry.player_id].reminders = event.entry.reminders
+
+    def stop(self):
+        self.connection.send(("stop", ()))
+        self.process.join()
+        self.executor.shutdown()
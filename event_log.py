@@ -0,0 +1,56 @@
+# file: event_log.py
+# Structured log of matches and queue events, one JSON object per line
+# Records are handed to a QueueListener thread which does the actual file writes, so logging never
+# waits on the disk. The file is rotated by size and rotated files are gzipped
+
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+logger = logging.getLogger("matchmaking")
+
+
+# Formats a record as a JSON line, with any fields passed to log_event as keys of their own
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {"time": record.created, "level": record.levelname, "logger": record.name,
+                "event": record.getMessage()}
+        line.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line)
+
+
+# Rotated log files are gzipped as they're rotated out
+def compress_rotated_log(source, dest):
+    with open(source, "rb") as log_file, gzip.open(dest, "wb") as compressed:
+        shutil.copyfileobj(log_file, compressed)
+    os.remove(source)
+
+
+# Send all logging to a rotating JSON lines file through a background thread
+# return: the listener, which has to be stopped on shutdown to write out anything still queued
+def setup(path, level, max_bytes, backup_count):
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = compress_rotated_log
+
+    # Records are formatted before they're queued, the file handler just writes them out
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.setFormatter(JSONFormatter())
+    listener = QueueListener(queue_handler.queue, file_handler)
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+# Log a named event with some fields, e.g. log_event("match", game_type="Superstars-On Ranked")
+def log_event(event, level=logging.INFO, **fields):
+    logger.log(level, event, extra={"fields": fields})
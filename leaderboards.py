@@ -0,0 +1,77 @@
+# file: leaderboards.py
+# The best users on each character for each stat, worked out from the local stat store with the same
+# formulas as %ostat/%pstat and kept in memory. After every pull from Project Rio only the characters
+# whose stats changed are rebuilt. Users with too few PA or IP are left out when a table is built
+
+import heapq
+
+import stats
+
+# Name used in %leaderboard -> (kind of stats, key in the stat line, higher is better, format, column header)
+LEADERBOARD_STATS = {
+    "avg": ("Batting", "avg", True, "{:.3f}", "AVG"),
+    "obp": ("Batting", "obp", True, "{:.3f}", "OBP"),
+    "slg": ("Batting", "slg", True, "{:.3f}", "SLG"),
+    "ops": ("Batting", "ops", True, "{:.3f}", "OPS"),
+    "ops+": ("Batting", "ops_plus", True, "{:.0f}", "OPS+"),
+    "oavg": ("Pitching", "d_avg", False, "{:.3f}", "oAVG"),
+    "era": ("Pitching", "era", False, "{:.2f}", "ERA"),
+    "k%": ("Pitching", "kp", True, "{:.1f}", "K%"),
+    "era-": ("Pitching", "era_minus", False, "{:.0f}", "ERA-"),
+}
+# Number of users kept in each table
+TOP_K = 10
+# Fewest plate appearances, and outs pitched, for a user to be on a leaderboard
+MIN_PA = 50
+MIN_OUTS_PITCHED = 60
+
+
+class Leaderboards:
+    def __init__(self, local_stats, top_k=TOP_K):
+        self.local_stats = local_stats
+        self.top_k = top_k
+        # (char_id, stat name) -> list of (user, value, sample size), best first. char_id None is all characters
+        self.tables = {}
+        # kind -> the char_fingerprints the tables were last built from
+        self.fingerprints = {"Batting": {}, "Pitching": {}}
+
+    # Rebuild the tables for every character whose stats of a kind have changed since the last build
+    # return: number of characters rebuilt
+    def refresh(self, kind):
+        fingerprints = self.local_stats.char_fingerprints(kind)
+        changed = [char_id for char_id in fingerprints if fingerprints[char_id] != self.fingerprints[kind].get(char_id)]
+        for char_id in changed:
+            self.build(kind, char_id)
+        self.fingerprints[kind] = fingerprints
+        return len(changed)
+
+    def build(self, kind, char_id):
+        league = self.local_stats.totals(kind, None, char_id)
+        lines = []
+        for user, totals in self.local_stats.user_totals(kind, char_id).items():
+            try:
+                if kind == "Batting":
+                    line = stats.batting_line(totals, league)
+                    if line["pa"] < MIN_PA:
+                        continue
+                    sample = str(line["pa"])
+                else:
+                    if totals["outs_pitched"] < MIN_OUTS_PITCHED:
+                        continue
+                    line = stats.pitching_line(totals, league)
+                    sample = line["ip"]
+            except ZeroDivisionError:
+                continue
+            lines.append((user, line, sample))
+
+        for stat in LEADERBOARD_STATS:
+            stat_kind, key, higher_is_better, number_format, header = LEADERBOARD_STATS[stat]
+            if stat_kind != kind:
+                continue
+            sign = 1 if higher_is_better else -1
+            best = heapq.nlargest(self.top_k, lines, key=lambda user_line: sign * user_line[1][key])
+            self.tables[(char_id, stat)] = [(user, line[key], sample) for user, line, sample in best]
+
+    # The table for a character (None for all characters) and stat, empty if it hasn't been built
+    def top(self, char_id, stat):
+        return self.tables.get((char_id, stat), [])
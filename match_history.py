@@ -0,0 +1,283 @@
+# file: match_history.py
+# Reads the match logs back for a report on how matchmaking has been going: matches per hour in each
+# mode, how far apart matched players were rated, how long players waited and how many gave up.
+# Both the old match_log.txt lines ("INFO:root:12 Superstars-Off Ranked match: Name 1500 vs Name 1480")
+# and the JSON lines of match_log.jsonl (rotated .gz files too) are read a line at a time through
+# generators into running totals and fixed buckets, so years of logs take no more memory than a day
+# The old lines have no times, so they only count towards the matches and rating gaps
+# With --tune the simulator is run with the arrivals, patience, modes and ratings seen in the logs
+# for a range of search range settings, to suggest percentile_range, range_growth_time and widening for a shard
+# usage: python match_history.py [--tune] [log files, oldest first]
+
+import argparse
+import glob
+import gzip
+import json
+import math
+import re
+
+import matchmaking_engine
+import simulate
+
+# Where the bot used to log its matches
+LEGACY_LOG_PATH = "match_log.txt"
+LEGACY_MATCH = re.compile(r"^INFO:root:(\d+) (.+?) match: (.*) (-?\d+(?:\.\d+)?) vs (.*) (-?\d+(?:\.\d+)?)$")
+# Bucket upper bounds for waits (seconds) and rating gaps, percentiles are read off them
+WAIT_BUCKETS = (15, 30, 60, 120, 180, 300, 600, 900, 1800, 3600)
+GAP_BUCKETS = (10, 25, 50, 75, 100, 150, 200, 300, 400)
+# Settings tried by --tune, and how long each simulation runs
+TUNE_PERCENTILE_RANGES = (0.05, 0.1, 0.15, 0.2, 0.3)
+TUNE_RANGE_GROWTH_TIMES = (60, 120, 180, 300, 600)
+TUNE_WIDENINGS = tuple(matchmaking_engine.WIDENING_POLICIES)
+TUNE_MINUTES = 600
+
+
+# A match: ratings of both players, and their waits and the time if the log had them
+class MatchRecord:
+    __slots__ = ("time", "game_type", "rating", "opponent_rating", "waits")
+
+    def __init__(self, match_time, game_type, rating, opponent_rating, waits):
+        self.time = match_time
+        self.game_type = game_type
+        self.rating = rating
+        self.opponent_rating = opponent_rating
+        self.waits = waits
+
+
+# A player who left the queue without a match
+class LeftRecord:
+    __slots__ = ("time", "game_type", "waited")
+
+    def __init__(self, left_time, game_type, waited):
+        self.time = left_time
+        self.game_type = game_type
+        self.waited = waited
+
+
+# The log files for the bot's log path, oldest first: the old text log, the rotated files, then the current one
+def log_paths(path, legacy_path=LEGACY_LOG_PATH):
+    rotated = sorted(glob.glob(glob.escape(path) + ".*.gz"), key=lambda name: -int(name.split(".")[-2]))
+    return glob.glob(glob.escape(legacy_path)) + rotated + glob.glob(glob.escape(path))
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as log_file:
+        yield from log_file
+
+
+def parse_legacy(lines):
+    for line in lines:
+        found = LEGACY_MATCH.match(line.rstrip("\n"))
+        if found:
+            yield MatchRecord(None, found.group(2), float(found.group(4)), float(found.group(6)), ())
+
+
+def parse_events(lines):
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event.get("event") == "match":
+            yield MatchRecord(event["time"], event["game_type"], event["rating"], event["opponent_rating"],
+                              (event["waited"], event["opponent_waited"]))
+        elif event.get("event") == "dequeue":
+            yield LeftRecord(event["time"], event["game_type"], event["waited"])
+
+
+# Every record in some log files, one file after another
+def read_records(paths):
+    for path in paths:
+        if ".jsonl" in path:
+            yield from parse_events(read_lines(path))
+        else:
+            yield from parse_legacy(read_lines(path))
+
+
+# Counts of values in fixed buckets, the last bucket being everything over the last bound
+class BucketCounts:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+
+    # The bound of the bucket a fraction of the values are in or under, so an upper estimate
+    def percentile(self, fraction):
+        if not self.total:
+            return 0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= self.total * fraction:
+                return bound
+        return math.inf
+
+    def labelled(self):
+        labels = ["<=" + str(bound) for bound in self.bounds] + [">" + str(self.bounds[-1])]
+        return dict(zip(labels, self.counts))
+
+
+class HistoryStats:
+    def __init__(self):
+        self.matches = {}
+        # Matches with times, which are the only ones matches per hour can be worked out from
+        self.timed_matches = {}
+        self.first_time = None
+        self.last_time = None
+        self.gaps = BucketCounts(GAP_BUCKETS)
+        self.waits = BucketCounts(WAIT_BUCKETS)
+        self.matched_players = 0
+        self.left = 0
+        # Every wait, matched or not, for the average patience
+        self.total_wait = 0
+        # For each ladder: count, sum and sum of squares of the ratings of matched players
+        self.ratings = {}
+
+    def add(self, record):
+        if record.time is not None:
+            if self.first_time is None or record.time < self.first_time:
+                self.first_time = record.time
+            if self.last_time is None or record.time > self.last_time:
+                self.last_time = record.time
+
+        if isinstance(record, LeftRecord):
+            self.left += 1
+            self.total_wait += record.waited
+            return
+        self.matches[record.game_type] = self.matches.get(record.game_type, 0) + 1
+        self.gaps.add(abs(record.rating - record.opponent_rating))
+        ladder = matchmaking_engine.rating_ladder(record.game_type)
+        count, total, squares = self.ratings.get(ladder, (0, 0, 0))
+        self.ratings[ladder] = (count + 2, total + record.rating + record.opponent_rating,
+                                squares + record.rating ** 2 + record.opponent_rating ** 2)
+        if record.time is not None:
+            self.timed_matches[record.game_type] = self.timed_matches.get(record.game_type, 0) + 1
+            for waited in record.waits:
+                self.waits.add(waited)
+                self.total_wait += waited
+            self.matched_players += len(record.waits)
+
+    def hours(self):
+        if self.first_time is None:
+            return 0
+        return (self.last_time - self.first_time) / 3600
+
+    # Share of players who left the queue without a match, out of those the logs say how they left
+    def abandonment_rate(self):
+        if not self.left + self.matched_players:
+            return 0
+        return self.left / (self.left + self.matched_players)
+
+    def report(self):
+        hours = self.hours()
+        return {"matches": sum(self.matches.values()),
+                "matches_by_mode": self.matches,
+                "matches_per_hour": {mode: round(self.timed_matches[mode] / hours, 2) for mode in self.timed_matches}
+                if hours else {},
+                "hours_logged": hours,
+                "wait_p50": self.waits.percentile(0.5),
+                "wait_p90": self.waits.percentile(0.9),
+                "wait_p99": self.waits.percentile(0.99),
+                "gap_p50": self.gaps.percentile(0.5),
+                "gap_p90": self.gaps.percentile(0.9),
+                "gaps": self.gaps.labelled(),
+                "left_unmatched": self.left,
+                "abandonment_rate": self.abandonment_rate()}
+
+    # Simulation arguments that reproduce the load in the logs
+    # return: dict of keyword arguments for simulate.Simulation, or None if there aren't enough timed records
+    def simulation_load(self):
+        hours = self.hours()
+        if not hours or not self.left or not self.matched_players:
+            return None
+        # Every player either matched or left, so this is how many joined
+        arrivals = (self.matched_players + self.left) / (hours * 60)
+        # Patience is taken to be exponential, and a matched player's wait only says their patience was longer,
+        # so its estimate is all the time spent waiting over the number of players who ran out of patience
+        patience = self.total_wait / self.left
+        mode_weights = tuple(self.timed_matches.get(mode, 0) for mode in matchmaking_engine.mode_list)
+        ladder_shapes = dict(simulate.LADDER_SHAPES)
+        for ladder in self.ratings:
+            count, total, squares = self.ratings[ladder]
+            mean = total / count
+            spread = math.sqrt(max(squares / count - mean ** 2, 0))
+            if ladder in ladder_shapes and spread:
+                ladder_shapes[ladder] = (ladder_shapes[ladder][0], mean, spread)
+        return {"arrivals": arrivals, "patience": patience, "mode_weights": mode_weights,
+                "ladder_shapes": ladder_shapes}
+
+
+def summarize(records):
+    history = HistoryStats()
+    for record in records:
+        history.add(record)
+    return history
+
+
+# Simulate the logged load with every pair of settings, and pick the one with the closest matches
+# that loses no more players than the current settings do
+# return: (best settings, list of (settings, simulation report)), or None if the logs can't be simulated
+def tune(history, minutes=TUNE_MINUTES, seed=1):
+    load = history.simulation_load()
+    if load is None:
+        return None
+
+    def abandonment(report):
+        return report["left_unmatched"] / max(report["left_unmatched"] + 2 * report["matches"], 1)
+
+    results = []
+    for widening in TUNE_WIDENINGS:
+        for percentile_range in TUNE_PERCENTILE_RANGES:
+            for range_growth_time in TUNE_RANGE_GROWTH_TIMES:
+                settings = {"percentile_range": percentile_range, "range_growth_time": range_growth_time,
+                            "widening": widening}
+                # Same seed every time, so every setting sees the same players
+                report = simulate.Simulation(seed, minutes=minutes, **load, **settings).run()
+                results.append((settings, report))
+
+    current = simulate.Simulation(seed, minutes=minutes, **load).run()
+    allowed = [(settings, report) for settings, report in results if abandonment(report) <= abandonment(current)]
+    if allowed:
+        best = min(allowed, key=lambda result: (result[1]["gap_p50"], result[1]["wait_p50"]))
+    else:
+        best = min(results, key=lambda result: abandonment(result[1]))
+    return best[0], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on the matchmaking logs")
+    parser.add_argument("paths", nargs="*", help="log files, oldest first (default: every match log here)")
+    parser.add_argument("--tune", action="store_true", help="suggest search range settings for the logged load")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    history = summarize(read_records(args.paths or log_paths("match_log.jsonl")))
+    simulate.print_report(history.report())
+    if not args.tune:
+        return
+
+    tuned = tune(history, seed=args.seed)
+    if tuned is None:
+        print("Not enough timed matches and departures in the logs to tune from")
+        return
+    best, results = tuned
+    print("Simulated load: " + ", ".join(key + " " + str(value) for key, value in history.simulation_load().items()))
+    for settings, report in results:
+        print("  " + settings["widening"] + ", percentile_range " + str(settings["percentile_range"]) +
+              ", range_growth_time " + str(settings["range_growth_time"]) + ": gap_p50 " + str(report["gap_p50"]) + ", wait_p50 " +
+              "{:.0f}".format(report["wait_p50"]) + ", left " + str(report["left_unmatched"]))
+    print("Suggested shard settings: " + json.dumps(best))
+
+
+if __name__ == "__main__":
+    main()
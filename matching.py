@@ -0,0 +1,402 @@
+# file: matching.py
+# Maximum weight matching in a general graph, used to pair up a mode's queue. Players can be paired
+# in any order of rating, so the graph isn't bipartite and augmenting paths have to handle odd cycles
+# ("blossoms"). This is Edmonds' blossom algorithm with the primal-dual weight updates of Galil's
+# "Efficient algorithms for finding maximum matching in graphs", O(n^3) for n vertices, in the form of
+# Joris van Rantwijk's public domain mwmatching.py
+# Dual variables are kept doubled, so with integer weights everything stays in integers
+
+
+# Finds a matching with the largest total weight
+# edges: list of (vertex, vertex, weight), vertices numbered from 0
+# max_cardinality: only consider matchings with as many edges as possible, and the largest weight among those
+# return: list with the vertex each vertex is matched to, or -1 if it isn't matched
+def max_weight_matching(edges, max_cardinality=False):
+    if not edges:
+        return []
+
+    edge_count = len(edges)
+    vertex_count = 1 + max(max(i, j) for i, j, weight in edges)
+    integer_weights = all(isinstance(weight, int) for i, j, weight in edges)
+    max_weight = max(0, max(weight for i, j, weight in edges))
+
+    # Edge k has endpoints 2k and 2k + 1, endpoint[p] is the vertex at endpoint p
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * edge_count)]
+    weights = [weight for i, j, weight in edges]
+    # For each vertex, the far endpoints of its edges
+    neighbour_ends = [[] for _ in range(vertex_count)]
+    for k, (i, j, weight) in enumerate(edges):
+        neighbour_ends[i].append(2 * k + 1)
+        neighbour_ends[j].append(2 * k)
+
+    # The endpoint each vertex is matched through, or -1
+    mate = [-1] * vertex_count
+    # Blossoms are numbered vertex_count and up, top level vertices and blossoms are labelled
+    # 0 (free), 1 (S, outer) or 2 (T, inner), along with the endpoint they were reached through
+    label = [0] * (2 * vertex_count)
+    label_end = [-1] * (2 * vertex_count)
+    # The top level blossom each vertex is in
+    in_blossom = list(range(vertex_count))
+    blossom_parent = [-1] * (2 * vertex_count)
+    # Sub-blossoms of each blossom going round its cycle from the base, and the endpoints joining them
+    blossom_children = [None] * (2 * vertex_count)
+    blossom_base = list(range(vertex_count)) + [-1] * vertex_count
+    blossom_endpoints = [None] * (2 * vertex_count)
+    # Least slack edge from each vertex or blossom to a different S blossom
+    best_edge = [-1] * (2 * vertex_count)
+    # For each S blossom, its least slack edges to every other S blossom
+    blossom_best_edges = [None] * (2 * vertex_count)
+    unused_blossoms = list(range(vertex_count, 2 * vertex_count))
+    dual = [max_weight] * vertex_count + [0] * vertex_count
+    # Edges with zero slack that can be used in an alternating tree
+    allowed = [False] * edge_count
+    queue = []
+
+    def slack(k):
+        i, j, weight = edges[k]
+        return dual[i] + dual[j] - 2 * weight
+
+    def blossom_leaves(b):
+        if b < vertex_count:
+            yield b
+        else:
+            for child in blossom_children[b]:
+                if child < vertex_count:
+                    yield child
+                else:
+                    yield from blossom_leaves(child)
+
+    # Label a free vertex w and its top level blossom t, reached through endpoint p
+    def assign_label(w, t, p):
+        b = in_blossom[w]
+        label[w] = label[b] = t
+        label_end[w] = label_end[b] = p
+        best_edge[w] = best_edge[b] = -1
+        if t == 1:
+            queue.extend(blossom_leaves(b))
+        else:
+            # The T blossom's base is matched, and its mate becomes an S vertex
+            base = blossom_base[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    # Trace back from two S vertices joined by an edge to see whether they're in the same tree
+    # return: the base of the new blossom if they are, or -1 if the edge is an augmenting path
+    def scan_blossom(v, w):
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = in_blossom[v]
+            if label[b] & 4:
+                base = blossom_base[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if label_end[b] == -1:
+                # Reached the root of the tree
+                v = -1
+            else:
+                v = endpoint[label_end[b]]
+                b = in_blossom[v]
+                v = endpoint[label_end[b]]
+            # Walk up both paths in turn
+            if w != -1:
+                v, w = w, v
+        for b in path:
+            label[b] = 1
+        return base
+
+    # Make a new blossom from the cycle through edge k, with the given base
+    def add_blossom(base, k):
+        v, w, weight = edges[k]
+        base_blossom = in_blossom[base]
+        bv = in_blossom[v]
+        bw = in_blossom[w]
+        b = unused_blossoms.pop()
+        blossom_base[b] = base
+        blossom_parent[b] = -1
+        blossom_parent[base_blossom] = b
+        blossom_children[b] = path = []
+        blossom_endpoints[b] = ends = []
+        # Round the cycle from v back to the base, then from the base out to w
+        while bv != base_blossom:
+            blossom_parent[bv] = b
+            path.append(bv)
+            ends.append(label_end[bv])
+            v = endpoint[label_end[bv]]
+            bv = in_blossom[v]
+        path.append(base_blossom)
+        path.reverse()
+        ends.reverse()
+        ends.append(2 * k)
+        while bw != base_blossom:
+            blossom_parent[bw] = b
+            path.append(bw)
+            ends.append(label_end[bw] ^ 1)
+            w = endpoint[label_end[bw]]
+            bw = in_blossom[w]
+        label[b] = 1
+        label_end[b] = label_end[base_blossom]
+        dual[b] = 0
+        # T vertices inside become S vertices, so they have to be scanned
+        for leaf in blossom_leaves(b):
+            if label[in_blossom[leaf]] == 2:
+                queue.append(leaf)
+            in_blossom[leaf] = b
+
+        # Least slack edges from the new blossom to each other S blossom
+        best_edge_to = [-1] * (2 * vertex_count)
+        for bv in path:
+            if blossom_best_edges[bv] is None:
+                edge_lists = [[p // 2 for p in neighbour_ends[leaf]] for leaf in blossom_leaves(bv)]
+            else:
+                edge_lists = [blossom_best_edges[bv]]
+            for edge_list in edge_lists:
+                for edge in edge_list:
+                    i, j, weight = edges[edge]
+                    if in_blossom[j] == b:
+                        i, j = j, i
+                    bj = in_blossom[j]
+                    if bj != b and label[bj] == 1 and (best_edge_to[bj] == -1 or
+                                                       slack(edge) < slack(best_edge_to[bj])):
+                        best_edge_to[bj] = edge
+            blossom_best_edges[bv] = None
+            best_edge[bv] = -1
+        blossom_best_edges[b] = [edge for edge in best_edge_to if edge != -1]
+        best_edge[b] = -1
+        for edge in blossom_best_edges[b]:
+            if best_edge[b] == -1 or slack(edge) < slack(best_edge[b]):
+                best_edge[b] = edge
+
+    # Break a blossom back up into its sub-blossoms
+    # end_stage: at the end of a stage, when zero dual sub-blossoms are expanded too
+    def expand_blossom(b, end_stage):
+        for child in blossom_children[b]:
+            blossom_parent[child] = -1
+            if child < vertex_count:
+                in_blossom[child] = child
+            elif end_stage and dual[child] == 0:
+                expand_blossom(child, end_stage)
+            else:
+                for leaf in blossom_leaves(child):
+                    in_blossom[leaf] = child
+
+        # A T blossom expanded mid-stage has its sub-blossoms relabelled along the even side of the cycle
+        if not end_stage and label[b] == 2:
+            entry_child = in_blossom[endpoint[label_end[b] ^ 1]]
+            j = blossom_children[b].index(entry_child)
+            if j & 1:
+                j -= len(blossom_children[b])
+                step = 1
+                end_trick = 0
+            else:
+                step = -1
+                end_trick = 1
+            p = label_end[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossom_endpoints[b][j - end_trick] ^ end_trick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowed[blossom_endpoints[b][j - end_trick] // 2] = True
+                j += step
+                p = blossom_endpoints[b][j - end_trick] ^ end_trick
+                allowed[p // 2] = True
+                j += step
+            # The base sub-blossom becomes the T blossom, without relabelling its mate
+            bv = blossom_children[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            label_end[endpoint[p ^ 1]] = label_end[bv] = p
+            best_edge[bv] = -1
+            # Sub-blossoms on the odd side that were reached from outside keep a T label
+            j += step
+            while blossom_children[b][j] != entry_child:
+                bv = blossom_children[b][j]
+                if label[bv] == 1:
+                    j += step
+                    continue
+                leaf = -1
+                for leaf in blossom_leaves(bv):
+                    if label[leaf] != 0:
+                        break
+                if label[leaf] != 0:
+                    label[leaf] = 0
+                    label[endpoint[mate[blossom_base[bv]]]] = 0
+                    assign_label(leaf, 2, label_end[leaf])
+                j += step
+
+        label[b] = label_end[b] = -1
+        blossom_children[b] = blossom_endpoints[b] = None
+        blossom_base[b] = -1
+        blossom_best_edges[b] = None
+        best_edge[b] = -1
+        unused_blossoms.append(b)
+
+    # Swap matched and unmatched edges round a blossom's cycle so that vertex v becomes its base
+    def augment_blossom(b, v):
+        child = v
+        while blossom_parent[child] != b:
+            child = blossom_parent[child]
+        if child >= vertex_count:
+            augment_blossom(child, v)
+        i = j = blossom_children[b].index(child)
+        if i & 1:
+            j -= len(blossom_children[b])
+            step = 1
+            end_trick = 0
+        else:
+            step = -1
+            end_trick = 1
+        while j != 0:
+            j += step
+            child = blossom_children[b][j]
+            p = blossom_endpoints[b][j - end_trick] ^ end_trick
+            if child >= vertex_count:
+                augment_blossom(child, endpoint[p])
+            j += step
+            child = blossom_children[b][j]
+            if child >= vertex_count:
+                augment_blossom(child, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        blossom_children[b] = blossom_children[b][i:] + blossom_children[b][:i]
+        blossom_endpoints[b] = blossom_endpoints[b][i:] + blossom_endpoints[b][:i]
+        blossom_base[b] = blossom_base[blossom_children[b][0]]
+
+    # Flip the matching along the augmenting path through edge k, back to the roots of both trees
+    def augment_matching(k):
+        v, w, weight = edges[k]
+        for s, p in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = in_blossom[s]
+                if bs >= vertex_count:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if label_end[bs] == -1:
+                    break
+                t = endpoint[label_end[bs]]
+                bt = in_blossom[t]
+                s = endpoint[label_end[bt]]
+                j = endpoint[label_end[bt] ^ 1]
+                if bt >= vertex_count:
+                    augment_blossom(bt, j)
+                mate[j] = label_end[bt]
+                p = label_end[bt] ^ 1
+
+    # Each stage grows alternating trees from every unmatched vertex until it finds an augmenting path
+    for _ in range(vertex_count):
+        label[:] = [0] * (2 * vertex_count)
+        best_edge[:] = [-1] * (2 * vertex_count)
+        blossom_best_edges[vertex_count:] = [None] * vertex_count
+        allowed[:] = [False] * edge_count
+        queue[:] = []
+        for v in range(vertex_count):
+            if mate[v] == -1 and label[in_blossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbour_ends[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if in_blossom[v] == in_blossom[w]:
+                        continue
+                    if not allowed[k]:
+                        # slack(k), written out as this is the innermost loop
+                        k_slack = dual[v] + dual[w] - 2 * weights[k]
+                        if k_slack <= 0:
+                            allowed[k] = True
+                    if allowed[k]:
+                        if label[in_blossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[in_blossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T blossom but not reached yet
+                            label[w] = 2
+                            label_end[w] = p ^ 1
+                    elif label[in_blossom[w]] == 1:
+                        b = in_blossom[v]
+                        if best_edge[b] == -1 or k_slack < slack(best_edge[b]):
+                            best_edge[b] = k
+                    elif label[w] == 0:
+                        if best_edge[w] == -1 or k_slack < slack(best_edge[w]):
+                            best_edge[w] = k
+            if augmented:
+                break
+
+            # No augmenting path with the edges allowed now, so change the duals by the most that keeps them
+            # feasible: 1 a vertex dual reaches zero, 2 an edge to a free vertex, 3 an edge between S blossoms
+            # becomes tight, 4 a T blossom's dual reaches zero
+            delta_type = -1
+            delta = delta_edge = delta_blossom = None
+            if not max_cardinality:
+                delta_type = 1
+                delta = min(dual[:vertex_count])
+            for v in range(vertex_count):
+                if label[in_blossom[v]] == 0 and best_edge[v] != -1:
+                    d = slack(best_edge[v])
+                    if delta_type == -1 or d < delta:
+                        delta = d
+                        delta_type = 2
+                        delta_edge = best_edge[v]
+            for b in range(2 * vertex_count):
+                if blossom_parent[b] == -1 and label[b] == 1 and best_edge[b] != -1:
+                    k_slack = slack(best_edge[b])
+                    d = k_slack // 2 if integer_weights else k_slack / 2
+                    if delta_type == -1 or d < delta:
+                        delta = d
+                        delta_type = 3
+                        delta_edge = best_edge[b]
+            for b in range(vertex_count, 2 * vertex_count):
+                if blossom_base[b] >= 0 and blossom_parent[b] == -1 and label[b] == 2 and \
+                        (delta_type == -1 or dual[b] < delta):
+                    delta = dual[b]
+                    delta_type = 4
+                    delta_blossom = b
+            if delta_type == -1:
+                # Nothing left to grow with max_cardinality, so finish as if a vertex dual had reached zero
+                delta_type = 1
+                delta = max(0, min(dual[:vertex_count]))
+
+            for v in range(vertex_count):
+                if label[in_blossom[v]] == 1:
+                    dual[v] -= delta
+                elif label[in_blossom[v]] == 2:
+                    dual[v] += delta
+            for b in range(vertex_count, 2 * vertex_count):
+                if blossom_base[b] >= 0 and blossom_parent[b] == -1:
+                    if label[b] == 1:
+                        dual[b] += delta
+                    elif label[b] == 2:
+                        dual[b] -= delta
+
+            if delta_type == 1:
+                break
+            elif delta_type == 2:
+                allowed[delta_edge] = True
+                i, j, weight = edges[delta_edge]
+                if label[in_blossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif delta_type == 3:
+                allowed[delta_edge] = True
+                i, j, weight = edges[delta_edge]
+                queue.append(i)
+            else:
+                expand_blossom(delta_blossom, False)
+
+        if not augmented:
+            break
+        # S blossoms whose dual has reached zero aren't needed any more
+        for b in range(vertex_count, 2 * vertex_count):
+            if blossom_parent[b] == -1 and blossom_base[b] >= 0 and label[b] == 1 and dual[b] == 0:
+                expand_blossom(b, True)
+
+    return [endpoint[p] if p >= 0 else -1 for p in mate]
@@ -0,0 +1,346 @@
+# file: matchmaking_engine.py
+# The matchmaking rules on their own, without Discord or Sheets: who gets matched with who, when,
+# and when players are due a reminder. The engine only works out what should happen and returns
+# it as a list of events, and whoever is driving it (the bot, or the simulator) does the sending
+# Time comes from an injected clock, and ratings from an injected rating provider, which needs
+# player_rating(game_type, player_id) and percentile_engine(game_type)
+
+import logging
+import math
+import time
+
+import event_log
+import matchmaking_queue
+
+mode_list = ["Superstars-Off Ranked", "Superstars-Off Unranked", "Superstars-On Ranked"]
+
+# Constant for starting percentile range for matchmaking search
+PERCENTILE_RANGE = 0.15
+# Seconds in the queue for a search range to grow by another PERCENTILE_RANGE
+RANGE_GROWTH_TIME = 180
+# Seconds an opponent must have been waiting before a queue refresh will match them
+MIN_QUEUE_TIME = 120
+# Seconds in the queue before a player's mode role is pinged, and before they are DMed
+REMINDER_TIMES = (300, 900)
+# Adaptive widening: seconds the arrival rate is averaged over, number of opponents a starting search range
+# should expect to see within RANGE_GROWTH_TIME, how far the growth time can be scaled down and up, and
+# how strongly that scale narrows (or widens) the range players join with
+ARRIVAL_RATE_WINDOW = 600
+TARGET_OPPONENTS = 2
+GROWTH_TIME_SCALE = (0.25, 4)
+JOIN_RANGE_EXPONENT = 0.5
+
+
+# The ladder the ratings for a game type come from
+def rating_ladder(game_type):
+    if game_type == "Superstars-On Ranked" or game_type == "Superstars-On Unranked":
+        return "ON"
+    return "OFF"
+
+
+# Search ranges are twice as wide in every mode but Superstars-Off Ranked
+def range_multiplier(game_type):
+    if game_type != "Superstars-Off Ranked":
+        return 2
+    return 1
+
+
+# Rating provider backed by a rating store (see storage.py) and a PercentileEngine for each ladder
+# percentile_engines is shared with whoever syncs the ladders, so changes to their ratings are seen here
+class LadderRatings:
+    def __init__(self, rating_store, percentile_engines, default_rating):
+        self.rating_store = rating_store
+        self.percentile_engines = percentile_engines
+        self.default_rating = default_rating
+
+    def player_rating(self, game_type, player_id):
+        return self.rating_store.latest_rating(rating_ladder(game_type), player_id, self.default_rating)
+
+    def percentile_engine(self, game_type):
+        return self.percentile_engines[rating_ladder(game_type)]
+
+
+# Search ranges grow by another percentile_range every range_growth_time seconds in the queue, however busy it is
+class LinearWidening:
+    def __init__(self, percentile_range, range_growth_time):
+        self.percentile_range = percentile_range
+        self.range_growth_time = range_growth_time
+
+    def joined(self, entry, now):
+        pass
+
+    # Called before search ranges are worked out, with the queue as it is now
+    def update(self, engine, now):
+        pass
+
+    # The percentile a queued player's search range covers now, before the mode's range_multiplier
+    def search_percentile(self, entry, now):
+        return self.percentile_range + self.percentile_range * (now - entry.time) / self.range_growth_time
+
+    # The time a queued player's search range will cover a percentile (before range_multiplier), if it keeps
+    # growing at the rate it is now
+    def reach_time(self, entry, percentile):
+        return entry.time + max(percentile / self.percentile_range - 1, 0) * self.range_growth_time
+
+    # How many times percentile_range a player's search range covers when they join a mode
+    def join_scale(self, game_type):
+        return 1
+
+    # How much of min_queue_time an opponent must have waited in a mode before a refresh matches them
+    def queue_time_scale(self, game_type):
+        return 1
+
+
+# Search ranges grow faster in a mode with few players around, and slower in a busy one
+# Each mode's growth time is range_growth_time scaled by how many opponents a starting search range can expect
+# to see in range_growth_time: players arriving (at the recent arrival rate, spread over the whole ladder),
+# plus the other players queued (spread over the part of the ladder they cover). Aiming at TARGET_OPPONENTS
+# The arrival rate is a moving average updated on each join, and the queue's spread comes from the ends of
+# its sorted ratings, so updating costs a couple of binary searches per mode
+# Each player's range is added to at the growth time in force for each stretch of their wait, so a change
+# in the growth time only changes how fast ranges grow from then on, and ranges never shrink
+# The same scale sets the range players join with (narrower in a busy mode, wider in a quiet one), and in a
+# quiet mode shortens min_queue_time, which otherwise keeps a wide range from reaching a newcomer for minutes
+class AdaptiveWidening(LinearWidening):
+    def __init__(self, percentile_range, range_growth_time):
+        super().__init__(percentile_range, range_growth_time)
+        # game_type -> (arrivals per second, time it was last updated)
+        self.arrival_rates = {}
+        # game_type -> how much range_growth_time is scaled by in it
+        self.scales = {}
+        # player_id -> (their QueueEntry, percentile their range had grown to, time it was worked out)
+        self.ranges = {}
+
+    def joined(self, entry, now):
+        self.arrival_rates[entry.game_type] = (self.arrival_rate(entry.game_type, now) + 1 / ARRIVAL_RATE_WINDOW, now)
+
+    def arrival_rate(self, game_type, now):
+        rate, updated = self.arrival_rates.get(game_type, (0, now))
+        return rate * math.exp(-(now - updated) / ARRIVAL_RATE_WINDOW)
+
+    def growth_time(self, game_type):
+        return self.range_growth_time * self.scales.get(game_type, 1)
+
+    # The range a player had grown to, and when, starting again if they've re-joined since
+    def grown_range(self, entry):
+        grown = self.ranges.get(entry.player_id)
+        if grown is None or grown[0] is not entry:
+            return self.percentile_range, entry.time
+        return grown[1], grown[2]
+
+    def update(self, engine, now):
+        # Grow everyone's range up to now at the growth times they've had since the last update
+        ranges = {}
+        for player_id in engine.queue:
+            entry = engine.queue[player_id]
+            ranges[player_id] = (entry, self.search_percentile(entry, now), now)
+        self.ranges = ranges
+
+        # Then work out the growth times from here on
+        for game_type in engine.modes:
+            start_range = 2 * engine.percentile_range * range_multiplier(game_type)
+            queued = engine.queue.ratings[game_type]
+            queued_density = 0
+            if len(queued) > 1:
+                percentile_engine = engine.ratings.percentile_engine(game_type)
+                size = len(percentile_engine) + 3
+                spread = (percentile_engine.count_above(queued[0], queued[0]) -
+                          percentile_engine.count_above(queued[-1], queued[-1])) / size
+                queued_density = (len(queued) - 1) / max(spread, start_range)
+            expected = start_range * (self.arrival_rate(game_type, now) * self.range_growth_time + queued_density)
+            self.scales[game_type] = min(max(expected / TARGET_OPPONENTS, GROWTH_TIME_SCALE[0]), GROWTH_TIME_SCALE[1])
+
+    def search_percentile(self, entry, now):
+        grown, updated = self.grown_range(entry)
+        return grown + self.percentile_range * max(now - updated, 0) / self.growth_time(entry.game_type)
+
+    def reach_time(self, entry, percentile):
+        grown, updated = self.grown_range(entry)
+        return updated + max(percentile - grown, 0) / self.percentile_range * self.growth_time(entry.game_type)
+
+    def join_scale(self, game_type):
+        return self.scales.get(game_type, 1) ** -JOIN_RANGE_EXPONENT
+
+    # Holding a newcomer back for a closer opponent is only worth it if one is likely to turn up
+    def queue_time_scale(self, game_type):
+        return min(self.scales.get(game_type, 1), 1)
+
+
+# Widening policies by the name an engine is given
+WIDENING_POLICIES = {"linear": LinearWidening, "adaptive": AdaptiveWidening}
+
+
+# A player joined the queue (or re-joined, replacing their old entry)
+class Joined:
+    __slots__ = ("entry",)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+
+# A player left the queue on their own
+class Left:
+    __slots__ = ("entry", "time")
+
+    def __init__(self, entry, left_time):
+        self.entry = entry
+        self.time = left_time
+
+
+# Players were matched and have been taken out of the queue
+class Matched:
+    __slots__ = ("matches", "time")
+
+    def __init__(self, matches, match_time):
+        # list of (entry, opponent entry)
+        self.matches = matches
+        self.time = match_time
+
+
+# A player is due a reminder: entry.reminders is 1 for the mode role ping and 2 for the DM
+class Reminder:
+    __slots__ = ("entry",)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+
+class MatchmakingEngine:
+    def __init__(self, rating_provider, clock=time.time, modes=mode_list, batch_pairing=True,
+                 percentile_range=PERCENTILE_RANGE, range_growth_time=RANGE_GROWTH_TIME,
+                 min_queue_time=MIN_QUEUE_TIME, reminder_times=REMINDER_TIMES, widening="linear"):
+        self.ratings = rating_provider
+        self.clock = clock
+        self.modes = modes
+        # Pair up everyone who can be matched on each refresh, instead of stopping at the first match
+        self.batch_pairing = batch_pairing
+        self.percentile_range = percentile_range
+        # How search ranges grow with time in the queue, one of WIDENING_POLICIES
+        self.widening = WIDENING_POLICIES[widening](percentile_range, range_growth_time)
+        self.min_queue_time = min_queue_time
+        self.reminder_times = reminder_times
+        self.queue = matchmaking_queue.MatchQueue(modes)
+
+    # A player enters the queue for a mode, and is matched straight away if anyone suitable is waiting
+    # If they are in the queue already this refreshes their place, and moves them if the mode is different
+    def join(self, player_id, name, game_type):
+        rating = self.ratings.player_rating(game_type, player_id)
+        entry = matchmaking_queue.QueueEntry(player_id, name, rating, self.clock(), game_type)
+        self.queue.add(entry)
+        self.widening.joined(entry, entry.time)
+        min_rating, max_rating = self.search_range(rating, game_type,
+                                                   self.percentile_range * self.widening.join_scale(game_type))
+        return [Joined(entry)] + self.check_for_match(player_id, min_rating, max_rating, 0)
+
+    def leave(self, player_id):
+        entry = self.queue.remove(player_id)
+        if entry is None:
+            return []
+        return [Left(entry, self.clock())]
+
+    # Check whether a match can now be made with the players waiting in the queue
+    def refresh(self):
+        search_ranges = self.search_ranges()
+        if self.batch_pairing:
+            matches = []
+            for mode in self.modes:
+                matches += self.queue.pair_players(mode, search_ranges, self.queue_time(mode), self.clock())
+            events = []
+            if matches:
+                events.append(self.match(matches))
+            for player in list(self.queue):
+                events += self.reminders(player)
+            return events
+
+        events = []
+        for player in self.queue:
+            min_rating, max_rating = search_ranges[player]
+            player_events = self.check_for_match(player, min_rating, max_rating,
+                                                 self.queue_time(self.queue[player].game_type))
+            events += player_events
+            if player_events and isinstance(player_events[0], Matched):
+                break
+        return events
+
+    # Checks if there is an available match for a user.
+    # Uses their user_id, search range (min-max ratings), and the min time an opponent must be searching to be matched.
+    def check_for_match(self, player_id, min_rating, max_rating, min_time):
+        entry = self.queue[player_id]
+        now = self.clock()
+        if event_log.logger.isEnabledFor(logging.DEBUG):
+            event_log.log_event("check", logging.DEBUG, player_id=player_id, name=entry.name, rating=entry.rating,
+                                waited=round(now - entry.time), min_rating=min_rating, max_rating=max_rating)
+        best_match = self.queue.closest(player_id, min_rating, max_rating, min_time, now)
+
+        if best_match:
+            return [self.match([(player_id, best_match)])]
+        return self.reminders(player_id)
+
+    # Take matched players (list of (player_id, opponent player_id)) out of the queue
+    def match(self, matches):
+        return Matched([(self.queue.remove(player_id), self.queue.remove(opponent_id))
+                        for player_id, opponent_id in matches], self.clock())
+
+    # Ping the role for a player's mode once they've waited 5 minutes, and DM them after 15 minutes
+    # Each reminder is sent once per time in the queue, whenever the queue is next checked after it's due
+    def reminders(self, player_id):
+        entry = self.queue[player_id]
+        waited = self.clock() - entry.time
+        events = []
+        if entry.reminders == 0 and waited > self.reminder_times[0]:
+            entry.reminders = 1
+            # No need for the ping if they're already due the DM
+            if waited < self.reminder_times[1]:
+                events.append(Reminder(entry))
+        if entry.reminders == 1 and waited > self.reminder_times[1]:
+            entry.reminders = 2
+            events.append(Reminder(entry))
+        return events
+
+    # Seconds an opponent must have been waiting in a mode before a refresh will match them
+    def queue_time(self, game_type):
+        return self.min_queue_time * self.widening.queue_time_scale(game_type)
+
+    # params: player's rating and what percentile you want your search range to cover
+    # return: min and max rating the player can match against
+    def search_range(self, rating, game_type, percentile):
+        return self.ratings.percentile_engine(game_type).search_range(rating, percentile * range_multiplier(game_type))
+
+    # Search ranges for every player in the queue, widened by how long each of them has been waiting
+    # return: dict of player_id -> (min rating, max rating)
+    def search_ranges(self):
+        now = self.clock()
+        self.widening.update(self, now)
+        search_ranges = {}
+        for game_type in self.modes:
+            entries = self.queue.players(game_type)
+            batch = []
+            for entry in entries:
+                new_range = self.widening.search_percentile(entry, now)
+                batch.append((entry.rating, new_range * range_multiplier(game_type)))
+            search_ranges.update(zip([entry.player_id for entry in entries],
+                                     self.ratings.percentile_engine(game_type).search_ranges(batch)))
+        return search_ranges
+
+    # The time a queued player's search range will have grown enough to include a rating
+    def reach_time(self, entry, rating):
+        percentile = self.ratings.percentile_engine(entry.game_type).percentile_to_reach(entry.rating, rating)
+        if percentile is None:
+            return None
+        return self.widening.reach_time(entry, percentile / range_multiplier(entry.game_type))
+
+    # Everything that's due to happen in the queue after now: a search range growing to reach a new
+    # opponent, an opponent passing min_queue_time, or a reminder coming due
+    # return: list of (time, description), earliest first
+    def deadlines(self, now):
+        deadlines = []
+        for mode in self.modes:
+            pairing_time = self.queue.next_pairing_time(mode, self.reach_time, self.queue_time(mode), now)
+            if pairing_time is not None:
+                deadlines.append((pairing_time, mode + " pairing"))
+        for player in self.queue:
+            entry = self.queue[player]
+            if entry.reminders < len(self.reminder_times):
+                deadlines.append((entry.time + self.reminder_times[entry.reminders], entry.name + " reminder"))
+        deadlines.sort()
+        return deadlines
@@ -0,0 +1,198 @@
+# file: matchmaking_queue.py
+# The matchmaking queue, split up by game mode with each mode kept sorted by rating, so finding
+# the closest rated opponent is a binary search instead of a scan over everyone in the queue
+
+from bisect import bisect_left, bisect_right
+
+import matching
+
+
+# One player waiting in the queue
+class QueueEntry:
+    __slots__ = ("player_id", "name", "rating", "time", "game_type", "reminders")
+
+    def __init__(self, player_id, name, rating, join_time, game_type):
+        self.player_id = player_id
+        self.name = name
+        self.rating = rating
+        self.time = join_time
+        self.game_type = game_type
+        # Number of "still waiting" reminders sent for this entry
+        self.reminders = 0
+
+
+class MatchQueue:
+    def __init__(self, modes):
+        # player_id -> QueueEntry, in the order players joined
+        self.entries = {}
+        # For each mode, the ratings of the players in it sorted low to high, and their IDs in the same order
+        self.ratings = {mode: [] for mode in modes}
+        self.player_ids = {mode: [] for mode in modes}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, player_id):
+        return player_id in self.entries
+
+    def __getitem__(self, player_id):
+        return self.entries[player_id]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    # Put a player in the queue, replacing their old entry if they were already in it
+    def add(self, entry):
+        self.remove(entry.player_id)
+        self.entries[entry.player_id] = entry
+        ratings = self.ratings[entry.game_type]
+        index = bisect_right(ratings, entry.rating)
+        ratings.insert(index, entry.rating)
+        self.player_ids[entry.game_type].insert(index, entry.player_id)
+
+    # Take a player out of the queue
+    # return: their entry, or None if they weren't in the queue
+    def remove(self, player_id):
+        entry = self.entries.pop(player_id, None)
+        if entry is not None:
+            index = self.index_of(entry)
+            del self.ratings[entry.game_type][index]
+            del self.player_ids[entry.game_type][index]
+        return entry
+
+    # Number of players queued for a mode
+    def count(self, game_type):
+        return len(self.ratings[game_type])
+
+    # Entries of everyone queued for a mode, lowest rating first
+    def players(self, game_type):
+        return [self.entries[player_id] for player_id in self.player_ids[game_type]]
+
+    # Where an entry sits in its mode's sorted lists
+    def index_of(self, entry):
+        ratings = self.ratings[entry.game_type]
+        player_ids = self.player_ids[entry.game_type]
+        index = bisect_left(ratings, entry.rating)
+        while player_ids[index] != entry.player_id:
+            index += 1
+        return index
+
+    # Finds the closest rated opponent for a player among those in the same mode, rated within
+    # min_rating-max_rating, that have been waiting longer than min_time seconds
+    # return: the opponent's player_id, or None if there isn't one
+    def closest(self, player_id, min_rating, max_rating, min_time, now):
+        entry = self.entries[player_id]
+        ratings = self.ratings[entry.game_type]
+        player_ids = self.player_ids[entry.game_type]
+        low = bisect_left(ratings, min_rating)
+        high = bisect_right(ratings, max_rating)
+
+        # Walk outwards from the player's rating, nearest candidate first
+        right = bisect_left(ratings, entry.rating)
+        left = right - 1
+        while True:
+            if left >= low and (right >= high or entry.rating - ratings[left] <= ratings[right] - entry.rating):
+                index = left
+                left -= 1
+            elif right < high:
+                index = right
+                right += 1
+            else:
+                return None
+
+            if index < low or player_ids[index] == player_id:
+                continue
+            if now - self.entries[player_ids[index]].time > min_time:
+                return player_ids[index]
+
+    # Pairs up as many players in a mode as possible, with the smallest total rating gap between
+    # opponents. Two players can be paired if either one is inside the other's search range and
+    # has been waiting longer than min_time seconds
+    # Pairs can cross in rating order (a wide range can reach past a closer player who can't reach back),
+    # so this is a maximum cardinality, maximum weight matching over the players who can be paired, with
+    # each pair weighted so that fewer total rating gap is more weight. The graph is split into the groups
+    # of players who can reach each other first, which keeps each matching small
+    # search_ranges: dict of player_id -> (min rating, max rating)
+    # return: list of (player_id, opponent player_id), closest pairs first
+    def pair_players(self, game_type, search_ranges, min_time, now):
+        ratings = self.ratings[game_type]
+        player_ids = self.player_ids[game_type]
+        if len(ratings) < 2:
+            return []
+        # Nobody can be paired with someone further away than the widest search range
+        max_gap = max(search_ranges[player_id][1] - search_ranges[player_id][0] for player_id in player_ids)
+
+        # Every pair that can play, as (index, index, rating gap), and the groups joined up by them
+        pairs = []
+        group_of = list(range(len(ratings)))
+
+        def group(index):
+            while group_of[index] != index:
+                group_of[index] = group_of[group_of[index]]
+                index = group_of[index]
+            return index
+
+        for a in range(len(ratings)):
+            for b in range(a + 1, len(ratings)):
+                gap = ratings[b] - ratings[a]
+                if gap > max_gap:
+                    break
+                if self.can_pair(player_ids[a], player_ids[b], search_ranges, min_time, now):
+                    pairs.append((a, b, gap))
+                    group_of[group(b)] = group(a)
+
+        groups = {}
+        for a, b, gap in pairs:
+            groups.setdefault(group(a), []).append((a, b, gap))
+
+        matches = []
+        for group_pairs in groups.values():
+            # Number the group's players from 0 for the matching
+            vertices = {}
+            edges = []
+            for a, b, gap in group_pairs:
+                # Every matching with the most pairs has the same number of them, so the most weight is the
+                # least total gap. Weights are kept above zero
+                edges.append((vertices.setdefault(a, len(vertices)), vertices.setdefault(b, len(vertices)),
+                              max_gap + 1 - gap))
+            indexes = sorted(vertices, key=vertices.get)
+            mates = matching.max_weight_matching(edges, max_cardinality=True)
+            for vertex, mate in enumerate(mates):
+                if mate > vertex:
+                    matches.append((player_ids[indexes[mate]], player_ids[indexes[vertex]]))
+
+        matches.sort(key=lambda match: abs(self.entries[match[0]].rating - self.entries[match[1]].rating))
+        return matches
+
+    def can_pair(self, player_id, opponent_id, search_ranges, min_time, now):
+        player = self.entries[player_id]
+        opponent = self.entries[opponent_id]
+        min_rating, max_rating = search_ranges[player_id]
+        if min_rating <= opponent.rating <= max_rating and now - opponent.time > min_time:
+            return True
+        min_rating, max_rating = search_ranges[opponent_id]
+        return min_rating <= player.rating <= max_rating and now - player.time > min_time
+
+    # Works out the next time after now that some pair of players in a mode becomes able to play
+    # each other, because a search range grew to reach a new opponent or an opponent has now waited
+    # longer than min_time
+    # reach_time: function(entry, rating) giving the time the entry's search range will include rating,
+    # or None if it never will. Search ranges only grow, so the further away a rating is the later it's reached
+    # return: the time, or None if nothing will change
+    def next_pairing_time(self, game_type, reach_time, min_time, now):
+        ratings = self.ratings[game_type]
+        player_ids = self.player_ids[game_type]
+        next_time = None
+        for index, player_id in enumerate(player_ids):
+            entry = self.entries[player_id]
+            for step in (-1, 1):
+                other = index + step
+                while 0 <= other < len(ratings):
+                    opponent_reached = reach_time(entry, ratings[other])
+                    if opponent_reached is None or (next_time is not None and opponent_reached >= next_time):
+                        break
+                    pairing_time = max(opponent_reached, self.entries[player_ids[other]].time + min_time)
+                    if pairing_time > now and (next_time is None or pairing_time < next_time):
+                        next_time = pairing_time
+                    other += step
+        return next_time
@@ -0,0 +1,133 @@
+# file: metrics.py
+# Counters, gauges and histograms for the bot's hot paths, served in the Prometheus text format
+# over a local HTTP endpoint. Updating a metric is a dict lookup and an add, so it's cheap enough
+# to do on every button press and every match check
+
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Every metric that has been created, in the order it was created
+registry = []
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace('"', '\\"') + '"'
+                          for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # label values -> count
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        return [(self.name + format_labels(self.labels, values), value) for values, value in self.values.items()]
+
+
+# A value that goes up and down. Can be set directly, or read from a function whenever it's scraped
+# (which should return a dict of label values -> value)
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        if self.function is not None:
+            self.values = self.function()
+        return super().samples()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (plus one for +Inf), sum]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    # Context manager that observes how long its block took
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def samples(self):
+        samples = []
+        for values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket" + format_labels(self.labels + ("le",), values + (bucket,)),
+                                cumulative))
+            samples.append((self.name + "_sum" + format_labels(self.labels, values), total))
+            samples.append((self.name + "_count" + format_labels(self.labels, values), cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+# Every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in registry:
+        lines.append("# HELP " + metric.name + " " + metric.description)
+        lines.append("# TYPE " + metric.name + " " + metric.kind)
+        for sample, value in metric.samples():
+            lines.append(sample + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Serve the metrics at http://host:port/metrics
+async def start_server(host, port):
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,139 @@
+# file: notifications.py
+# Sends the bot's Discord messages (match announcements, role pings and DMs) from a queue of its own,
+# so a slow DM or a rate limit never holds up matchmaking. A few workers send at once, each kind of
+# message is paced by a token bucket per channel (or for DMs), and every message has a key so the
+# same reminder or announcement is never sent twice
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import discord
+
+import metrics
+
+# Messages being sent at once
+NOTIFY_CONCURRENCY = 4
+# Messages per second and burst size for each kind of route
+ROUTE_RATES = {"channel": (1, 5), "dm": (0.5, 2)}
+# Tries for a message that fails with a server error, and seconds before the first retry (doubling each time)
+NOTIFY_ATTEMPTS = 3
+NOTIFY_RETRY_DELAY = 2
+# Number of recently sent keys remembered, and of users kept after fetching them
+SENT_KEYS_SIZE = 10000
+USER_CACHE_SIZE = 1000
+
+notifications_sent = metrics.Counter("mmbot_notifications_total", "Discord messages sent from the notification queue",
+                                     ("kind", "result"))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Reserve the next token. Tokens can be reserved before they've refilled, so callers are served in order
+    # return: seconds until the reserved token can be used
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0)
+
+    async def acquire(self):
+        wait = self.take()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class Notifier:
+    def __init__(self, bot, concurrency=NOTIFY_CONCURRENCY):
+        self.bot = bot
+        self.concurrency = concurrency
+        # (kind, target, content, key, attempt)
+        self.pending = asyncio.Queue()
+        self.buckets = {}
+        # Keys queued or sent, oldest first
+        self.keys = OrderedDict()
+        # user_id -> User fetched from the API, least recently used first
+        self.users = OrderedDict()
+        self.workers = []
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    # Queue a message for a channel
+    # key: anything identifying the message, messages with a key that's already been queued are dropped
+    def channel_message(self, channel_id, content, key=None):
+        self.submit("channel", channel_id, content, key)
+
+    # Queue a DM for a user
+    def direct_message(self, user_id, content, key=None):
+        self.submit("dm", user_id, content, key)
+
+    def submit(self, kind, target, content, key):
+        if key is not None:
+            if key in self.keys:
+                return
+            self.keys[key] = True
+            if len(self.keys) > SENT_KEYS_SIZE:
+                self.keys.popitem(last=False)
+        self.pending.put_nowait((kind, target, content, key, 1))
+
+    # Number of messages waiting to be sent
+    def backlog(self):
+        return self.pending.qsize()
+
+    async def work(self):
+        while True:
+            kind, target, content, key, attempt = await self.pending.get()
+            route = (kind, target) if kind == "channel" else (kind,)
+            if route not in self.buckets:
+                self.buckets[route] = TokenBucket(*ROUTE_RATES[kind])
+            await self.buckets[route].acquire()
+            try:
+                await self.send(kind, target, content)
+                notifications_sent.inc(kind, "sent")
+            except discord.HTTPException as error:
+                # Other than a rate limit, a 4xx means the message itself was refused (DMs turned off, the
+                # channel or user gone, a bad message), and trying again won't help
+                if 400 <= error.status < 500 and error.status != 429:
+                    notifications_sent.inc(kind, "failed")
+                    logging.warning("Couldn't send a " + kind + " message to " + str(target) + ": " + str(error))
+                elif attempt < NOTIFY_ATTEMPTS:
+                    notifications_sent.inc(kind, "retried")
+                    asyncio.get_running_loop().call_later(NOTIFY_RETRY_DELAY * 2 ** (attempt - 1),
+                                                          self.pending.put_nowait,
+                                                          (kind, target, content, key, attempt + 1))
+                else:
+                    notifications_sent.inc(kind, "failed")
+                    logging.exception("Gave up sending a " + kind + " message to " + str(target))
+            except Exception:
+                # Keep the worker going whatever went wrong
+                notifications_sent.inc(kind, "failed")
+                logging.exception("Couldn't send a " + kind + " message to " + str(target))
+
+    async def send(self, kind, target, content):
+        if kind == "channel":
+            await self.bot.get_channel(target).send(content)
+        else:
+            user = await self.get_user(target)
+            await user.send(content)
+
+    # A user from the bot's member cache, or from the API if they aren't in it, only fetching each user once
+    async def get_user(self, user_id):
+        user = self.bot.get_user(int(user_id))
+        if user is not None:
+            return user
+        user = self.users.pop(user_id, None)
+        if user is None:
+            user = await self.bot.fetch_user(int(user_id))
+        self.users[user_id] = user
+        if len(self.users) > USER_CACHE_SIZE:
+            self.users.popitem(last=False)
+        return user
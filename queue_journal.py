@@ -0,0 +1,104 @@
+# file: queue_journal.py
+# Append-only journal of everything that happens to the matchmaking queue, so a restart can put
+# everyone back in the queue with their original join times (and so their widened search ranges)
+# Each line is one JSON event. Writes are flushed straight away but only fsynced every so often,
+# and the journal is rewritten as a snapshot of the current queue once it has grown enough
+
+import json
+import os
+
+import matchmaking_queue
+
+
+def enqueue_event(entry):
+    return {"event": "enqueue", "player_id": entry.player_id, "name": entry.name, "rating": entry.rating,
+            "time": entry.time, "game_type": entry.game_type, "reminders": entry.reminders}
+
+
+class QueueJournal:
+    def __init__(self, path, compact_events):
+        self.path = path
+        # Number of events after which the journal gets rewritten as a snapshot
+        self.compact_events = compact_events
+        self.events = 0
+        self.unsynced = False
+        self.file = None
+
+    # Rebuild the queue from the journal
+    # return: the match count to carry on from, or None if the journal didn't have one
+    def replay(self, queue):
+        match_count = None
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # A line cut off by a crash mid-write
+                        continue
+                    self.events += 1
+                    if event["event"] == "enqueue":
+                        if event["game_type"] in queue.ratings:
+                            entry = matchmaking_queue.QueueEntry(event["player_id"], event["name"], event["rating"],
+                                                                 event["time"], event["game_type"])
+                            entry.reminders = event.get("reminders", 0)
+                            queue.add(entry)
+                    elif event["event"] in ("dequeue", "match"):
+                        for player_id in event["player_ids"]:
+                            queue.remove(player_id)
+                    elif event["event"] == "reminder":
+                        if event["player_id"] in queue:
+                            queue[event["player_id"]].reminders = event["reminders"]
+                    if "match_count" in event:
+                        match_count = event["match_count"]
+        self.file = open(self.path, "a")
+        # Finish off a line cut off by a crash so the next event starts on its own line
+        if self.file.tell() > 0:
+            with open(self.path, "rb") as journal:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b"\n":
+                    self.file.write("\n")
+        return match_count
+
+    def enqueue(self, entry):
+        self.write(enqueue_event(entry))
+
+    def dequeue(self, player_id):
+        self.write({"event": "dequeue", "player_ids": [player_id]})
+
+    # match_count is the count to carry on from after this match
+    def match(self, player_id, opponent_id, match_count):
+        self.write({"event": "match", "player_ids": [player_id, opponent_id], "match_count": match_count})
+
+    def reminder(self, entry):
+        self.write({"event": "reminder", "player_id": entry.player_id, "reminders": entry.reminders})
+
+    def write(self, event):
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+        self.events += 1
+        self.unsynced = True
+
+    # Make sure everything written so far is on disk
+    def sync(self):
+        if self.unsynced:
+            self.unsynced = False
+            os.fsync(self.file.fileno())
+
+    def needs_compacting(self):
+        return self.events > self.compact_events
+
+    # Rewrite the journal as just the current queue and match count
+    def compact(self, queue, match_count):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as snapshot:
+            for player_id in queue:
+                snapshot.write(json.dumps(enqueue_event(queue[player_id])) + "\n")
+            snapshot.write(json.dumps({"event": "count", "match_count": match_count}) + "\n")
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, "a")
+        self.events = len(queue) + 1
+        self.unsynced = False
@@ -0,0 +1,263 @@
+# file: ratings.py
+# Local rating data built from bulk reads of the ratings spreadsheet, so the bot
+# doesn't have to go to the Google API every time someone presses a queue button
+
+import zlib
+
+# Discord user IDs are snowflakes, which are much longer than any other number in the logs
+MIN_ID_LENGTH = 15
+
+# Ratings added to the ends of every ladder, so a search range always has somewhere to stop
+MIN_SENTINEL_RATING = 0
+MAX_SENTINEL_RATING = 3000
+
+
+# Add the ratings found in some Logs sheet rows to a player_id -> latest rating index
+# Same lookup the old findall did: the last occurrence of a player ID wins, and their rating
+# is in the cell three columns to the right of the ID
+def index_log_rows(rows, index):
+    for row in rows:
+        for col, value in enumerate(row):
+            if len(value) >= MIN_ID_LENGTH and value.isdigit() and col + 3 < len(row):
+                try:
+                    index[value] = round(float(row[col + 3]))
+                except ValueError:
+                    pass
+    return index
+
+
+# Spreadsheet column letter for a 1-based column number (1 -> A, 27 -> AA)
+def column_letter(col):
+    letters = ""
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+# Rows come back from the API with their trailing blank cells trimmed off (but get_all_values pads
+# them), so compare rows on their contents only
+def row_checksum(row):
+    row = list(row)
+    while row and row[-1] == "":
+        row.pop()
+    return zlib.crc32("\t".join(row).encode())
+
+
+# Follows the bottom of a Logs sheet, remembering the last row it has read so each refresh only
+# downloads the games logged since. The logs only ever grow at the bottom, so if the last row we
+# read has disappeared or changed, something was edited by hand and we read the whole sheet again
+class LogTail:
+    # row_count and last_row_checksum pick up from a position saved from an earlier tail
+    def __init__(self, worksheet, row_count=0, last_row_checksum=None):
+        self.worksheet = worksheet
+        self.row_count = row_count
+        self.last_row_checksum = last_row_checksum
+
+    # Download the rows that have been added since the last read
+    # Only touches the network, the tail doesn't move until advance() is called with the position
+    # returned here, once the rows have been stored. A read that times out and finishes late on its
+    # thread then can't skip rows that were never stored
+    # return: the rows, True if they are the whole sheet rather than just the new rows, and the
+    # position after them as (row count, checksum of the last row)
+    def read_new_rows(self):
+        if self.row_count == 0:
+            return self.read_all_rows()
+
+        # Start from the last row we already have so we can check it hasn't changed
+        rows = self.worksheet.get("A" + str(self.row_count) + ":" + column_letter(self.worksheet.col_count))
+        if not rows or row_checksum(rows[0]) != self.last_row_checksum:
+            return self.read_all_rows()
+
+        new_rows = rows[1:]
+        if not new_rows:
+            return new_rows, False, (self.row_count, self.last_row_checksum)
+        return new_rows, False, (self.row_count + len(new_rows), row_checksum(new_rows[-1]))
+
+    def read_all_rows(self):
+        rows = self.worksheet.get_all_values()
+        return rows, True, (len(rows), row_checksum(rows[-1]) if rows else None)
+
+    # Move the tail to a position returned by read_new_rows, after its rows have been stored
+    def advance(self, position):
+        self.row_count, self.last_row_checksum = position
+
+
+# Add rows read by a LogTail to a rating index
+# A full read replaces the index in one step, so lookups never see it half built
+def apply_log_rows(index, rows, full_sync):
+    if full_sync:
+        new_index = index_log_rows(rows, {})
+        index.clear()
+        index.update(new_index)
+    else:
+        index_log_rows(rows, index)
+
+
+# player -> rating from the player and rating columns of a STARS sheet, header row left off
+# Rows with no rating are skipped. A player named on more than one row (or on none) still gets a key
+# of their own, so the ladder never loses a rating
+def stars_players(player_cells, rating_cells):
+    ladder_players = {}
+    for index, rating in enumerate(rating_cells):
+        if rating == "":
+            continue
+        row = str(index + 2)
+        player = player_cells[index] if index < len(player_cells) else ""
+        key = player if player and player not in ladder_players else (player + " (row " + row + ")").lstrip()
+        ladder_players[key] = int(rating)
+    return ladder_players
+
+
+# Finds the rating range covering a percentile of a ladder around a player's rating
+# Gives the same ranges as sorting the ladder together with the player's rating and the two sentinel
+# ratings, and counting positions from the top
+# Ratings are whole numbers in a small range (the sentinels' 0-3000, unless someone is rated outside
+# them), so the ladder is kept as a Fenwick tree counting the players on each rating: counting the
+# ratings above a value, finding the rating at a position and moving one player are all O(log R) for
+# R possible ratings, however many players are on the ladder
+# The ladder is keyed by player, the same way the STARS sheet is, so a read of the sheet only has to
+# move the players whose rating changed
+class PercentileEngine:
+    # ladder_players: player -> rating
+    def __init__(self, ladder_players):
+        self.players = {}
+        # value -> count_up_to(value), since the last change
+        self.counts_up_to = {}
+        self.build(MIN_SENTINEL_RATING, MAX_SENTINEL_RATING)
+        self.apply_changes(list(ladder_players.items()))
+
+    def __len__(self):
+        return len(self.players)
+
+    # Start a tree covering ratings low to high and put the players in it
+    def build(self, low, high):
+        self.low = low
+        self.tree = [0] * (high - low + 2)
+        # Highest power of two in the tree, where select() starts its descent
+        self.top_step = 1 << (len(self.tree) - 1).bit_length() - 1
+        for rating in self.players.values():
+            self.add(rating, 1)
+
+    # Change the number of players on a rating
+    def add(self, rating, change):
+        self.counts_up_to.clear()
+        index = rating - self.low + 1
+        while index < len(self.tree):
+            self.tree[index] += change
+            index += index & -index
+
+    # Number of players rated at most a value
+    # The same few values (the queued players' ratings and the sentinels) are looked up over and over
+    # between changes to the ladder, so the counts are remembered until the next change
+    def count_up_to(self, value):
+        count = self.counts_up_to.get(value)
+        if count is not None:
+            return count
+        tree = self.tree
+        index = min(value - self.low + 1, len(tree) - 1)
+        count = 0
+        while index > 0:
+            count += tree[index]
+            index &= index - 1
+        self.counts_up_to[value] = count
+        return count
+
+    # Rating of the player at an index in the ladder sorted lowest first
+    def select(self, index):
+        tree = self.tree
+        size = len(tree)
+        position = 0
+        step = self.top_step
+        while step:
+            if position + step < size and tree[position + step] <= index:
+                position += step
+                index -= tree[position]
+            step >>= 1
+        return position + self.low
+
+    # Make the ladder match a new read of the STARS sheet
+    # return: the changes, as a list of (player, new rating or None if they left the ladder)
+    def update(self, ladder_players):
+        changes = [(player, rating) for player, rating in ladder_players.items()
+                   if self.players.get(player) != rating]
+        changes += [(player, None) for player in self.players if player not in ladder_players]
+        self.apply_changes(changes)
+        return changes
+
+    # Apply a list of (player, new rating or None if they left the ladder)
+    def apply_changes(self, changes):
+        for player, rating in changes:
+            old_rating = self.players.pop(player, None)
+            if old_rating is not None:
+                self.add(old_rating, -1)
+            if rating is None:
+                continue
+            high = self.low + len(self.tree) - 2
+            if rating < self.low or rating > high:
+                self.build(min(rating, self.low), max(rating, high))
+            self.players[player] = rating
+            self.add(rating, 1)
+
+    # params: player's rating and what percentile of the ladder the range should cover on each side
+    # return: min and max rating the player can match against
+    def search_range(self, rating, percentile):
+        size = len(self.players) + 3
+        position = self.count_above(rating, rating)
+        max_position = round(position - (size * percentile))
+        min_position = round(position + (size * percentile))
+        if max_position < 0:
+            max_position = 0
+        if min_position >= size:
+            min_position = size - 1
+
+        return self.rating_at(min_position, rating), self.rating_at(max_position, rating)
+
+    # Same as search_range for a whole batch of (rating, percentile) pairs
+    def search_ranges(self, players):
+        return [self.search_range(rating, percentile) for rating, percentile in players]
+
+    # Smallest percentile (exclusive) that makes a player's search range include another rating
+    # return: the percentile, or None if no range will ever reach that rating
+    def percentile_to_reach(self, rating, other_rating):
+        size = len(self.players) + 3
+        # Position of the player's rating counting from the top of the ladder
+        position = self.count_above(rating, rating)
+        if other_rating > rating:
+            # The top of the range has to reach the lowest position still rated at least other_rating
+            target = self.count_above(other_rating, rating, inclusive=True) - 1
+            if target < 0:
+                return None
+            return (position - target - 0.5) / size
+        if other_rating < rating:
+            # The bottom of the range has to reach the highest position rated at most other_rating
+            target = self.count_above(other_rating, rating)
+            if target >= size:
+                return None
+            return (target - position - 0.5) / size
+        return 0
+
+    # Number of ratings above a value, with the player's rating and the sentinels merged into the ladder
+    def count_above(self, value, rating, inclusive=False):
+        if inclusive:
+            count = len(self.players) - self.count_up_to(value - 1)
+            extras = [extra for extra in (MIN_SENTINEL_RATING, MAX_SENTINEL_RATING, rating) if extra >= value]
+        else:
+            count = len(self.players) - self.count_up_to(value)
+            extras = [extra for extra in (MIN_SENTINEL_RATING, MAX_SENTINEL_RATING, rating) if extra > value]
+        return count + len(extras)
+
+    # Rating at a position counted from the top of the ladder, with the player's rating and the
+    # sentinels merged in
+    def rating_at(self, position, rating):
+        # Count from the bottom instead, since the tree counts from the lowest rating
+        index = len(self.players) + 2 - position
+        extras = sorted((MIN_SENTINEL_RATING, MAX_SENTINEL_RATING, rating))
+        for i, extra in enumerate(extras):
+            # Where this extra rating lands in the merged ladder
+            extra_index = self.count_up_to(extra) + i
+            if index == extra_index:
+                return extra
+            if index < extra_index:
+                return self.select(index - i)
+        return self.select(index - len(extras))
@@ -0,0 +1,448 @@
+# file: shard.py
+# Matchmaking for one community: its buttons and match channel, its ratings spreadsheet and store,
+# its queue and journal. Each shard runs its own matchmaker, status and Sheets tasks, so a busy
+# ladder can't hold up another one's refreshes, and can run its matchmaking engine in a worker
+# process (see engine_worker.py) if one event loop isn't enough
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+from discord import ButtonStyle
+from discord.ui import Button, View
+
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+
+import api
+import engine_worker
+import event_log
+import matchmaking_engine
+import matchmaking_queue
+import metrics
+import queue_journal
+import ratings
+import storage
+
+# Google service account credentials used to open every shard's spreadsheet
+CLIENT_SECRET_PATH = "client_secret.json"
+# Seconds to wait before trying to open a spreadsheet again if Google is unavailable
+SHEETS_RETRY_DELAY = 60
+# Seconds between syncs of the ratings from a spreadsheet
+SHEETS_REFRESH_INTERVAL = 60
+# A STARS sheet is only read again when new games have been logged, or after this many seconds in case
+# it was edited by hand
+STARS_READ_INTERVAL = 1800
+# Rating for players with no logged games
+DEFAULT_RATING = 1400
+# Longest the matchmaker sleeps when nothing is due to change
+MATCHMAKER_IDLE_TIMEOUT = 60
+# Seconds to wake up after a predicted deadline, so the match it predicts is definitely possible by then
+DEADLINE_MARGIN = 0.05
+# Minimum seconds between edits of the queue status message, so bursts of button presses don't hit rate limits
+STATUS_EDIT_INTERVAL = 3
+# Seconds between fsyncs of the journal
+QUEUE_JOURNAL_SYNC_INTERVAL = 1
+# Number of journal events before it's rewritten as a snapshot of the current queue
+QUEUE_JOURNAL_COMPACT_EVENTS = 1000
+FEEDBACK_URL = "https://forms.gle/KNKwp86VFxrgkZiW9"
+# Longest message Discord accepts, in characters
+MESSAGE_LIMIT = 2000
+# Shard config keys passed on to the matchmaking engine when they're set, e.g. as suggested by match_history.py --tune
+ENGINE_SETTINGS = ("percentile_range", "range_growth_time", "widening")
+
+# Buckets for how long players wait for a match, in seconds
+WAIT_BUCKETS = (15, 30, 60, 120, 180, 300, 600, 900, 1800, 3600)
+time_to_match = metrics.Histogram("mmbot_time_to_match_seconds", "How long matched players waited in the queue",
+                                  ("shard", "mode"), WAIT_BUCKETS)
+matches_made = metrics.Counter("mmbot_matches_total", "Matches announced", ("shard", "mode"))
+match_search_seconds = metrics.Histogram("mmbot_match_search_seconds",
+                                         "Time the engine spends matching players, on joining or on a refresh",
+                                         ("shard", "kind"))
+sheets_refresh_seconds = metrics.Histogram("mmbot_sheets_refresh_seconds",
+                                           "Time taken by each refresh of the ratings from Sheets", ("shard",))
+status_edit_seconds = metrics.Histogram("mmbot_status_edit_seconds", "Time taken by each edit of the queue status",
+                                        ("shard",))
+
+
+# Log in to Google and open each ladder's STARS and Logs worksheets
+# Blocking, so this goes on the Sheets thread pool
+def open_ladder_sheets(spreadsheet_key, ladder_worksheets):
+    # use creds to create a client to interact with the Google Drive API
+    scope = ["https://spreadsheets.google.com/feeds",
+             "https://www.googleapis.com/auth/drive"]
+    creds = ServiceAccountCredentials.from_json_keyfile_name(CLIENT_SECRET_PATH, scope)
+    client = gspread.authorize(creds)
+    spreadsheet = client.open_by_key(spreadsheet_key)
+    return {ladder: (spreadsheet.worksheet(ladder_worksheets[ladder][0]), spreadsheet.worksheet(ladder_worksheets[ladder][1]))
+            for ladder in ladder_worksheets}
+
+
+class Shard:
+    # config: dict with the shard's name, button_channel_id, match_channel_id, role_ids (mode -> role to
+    # ping), spreadsheet_key, ladder_worksheets, stars_columns, storage_backend, ratings_db_path,
+    # queue_journal_path, batch_pairing and worker_process (see SHARDS in MSSBMatchmakingBot.py), and
+    # optionally any ENGINE_SETTINGS
+    # notifier: the Notifier all the bot's messages are sent through
+    # startup_timings: dict to record how long this shard took to start up in
+    def __init__(self, bot, notifier, config, startup_timings):
+        started = time.perf_counter()
+        self.bot = bot
+        self.notifier = notifier
+        self.name = config["name"]
+        self.button_channel_id = config["button_channel_id"]
+        self.match_channel_id = config["match_channel_id"]
+        self.role_ids = config["role_ids"]
+        self.modes = config.get("modes", matchmaking_engine.mode_list)
+        self.spreadsheet_key = config["spreadsheet_key"]
+        self.ladder_worksheets = config["ladder_worksheets"]
+        self.stars_columns = config["stars_columns"]
+        self.startup_timings = startup_timings
+
+        # All rating lookups are answered from the store, the spreadsheet is only synced into it
+        self.rating_store = storage.open_store(config["storage_backend"], config["ratings_db_path"])
+        # Writes to the store run on their own thread, one at a time, so a full resync of the logs doesn't
+        # hold up the event loop
+        self.store_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-" + self.name)
+        # Every player's rating on each ladder (to be used for defining percentile search ranges)
+        # Starts from the ratings saved by the last run, so the bot can connect to Discord straight away
+        # and sync with the spreadsheet in the background
+        self.percentile_engines = {ladder: ratings.PercentileEngine(self.rating_store.ladder_players(ladder))
+                                   for ladder in self.ladder_worksheets}
+        # time.monotonic() of the last read of each ladder's STARS sheet
+        self.stars_read_times = {}
+        # The STARS and Logs worksheets for each ladder, once the spreadsheet has been opened
+        self.ladder_sheets = {}
+        # The tails remember how far down the logs have been read, so refreshes only fetch new games
+        self.log_tails = {}
+        # The latest read of each ladder on the Sheets thread pool, which may still be running after the wait
+        # for it timed out. A ladder isn't read again until its last read has really finished
+        self.ladder_reads = {}
+
+        # Journal of queue changes, replayed on startup so a restart doesn't cost anyone their place in the queue
+        self.journal = queue_journal.QueueJournal(config["queue_journal_path"], QUEUE_JOURNAL_COMPACT_EVENTS)
+
+        # Decides who gets matched and when, either here or in a worker process
+        # With a worker, self.queue is the copy of the worker's queue that's kept here
+        self.engine = None
+        self.worker = None
+        engine_settings = {key: config[key] for key in ENGINE_SETTINGS if key in config}
+        if config["worker_process"]:
+            if config["storage_backend"] != "sqlite":
+                raise ValueError("Shard " + self.name + " needs the sqlite backend to run in a worker process")
+            self.queue = matchmaking_queue.MatchQueue(self.modes)
+        else:
+            self.engine = matchmaking_engine.MatchmakingEngine(
+                matchmaking_engine.LadderRatings(self.rating_store, self.percentile_engines, DEFAULT_RATING),
+                modes=self.modes, batch_pairing=config["batch_pairing"], **engine_settings)
+            self.queue = self.engine.queue
+        self.match_count = self.journal.replay(self.queue) or 1
+        if config["worker_process"]:
+            self.worker = engine_worker.EngineWorker(
+                self.queue, config["batch_pairing"], config["ratings_db_path"],
+                {ladder: dict(self.percentile_engines[ladder].players) for ladder in self.percentile_engines},
+                DEFAULT_RATING, engine_settings)
+
+        # The message with the matchmaking bot stuff, and the queue status last written to it
+        self.mm_message = None
+        self.mm_message_status = None
+        # Set when players join or leave the queue so the matchmaker wakes up and re-plans
+        self.queue_changed = asyncio.Event()
+        # Set when the queue status message needs updating
+        self.status_changed = asyncio.Event()
+        self.tasks = []
+        self.startup_timings[self.name + " load stored ratings"] = time.perf_counter() - started
+
+    # Post the buttons, and start the shard's tasks the first time round
+    async def start(self):
+        await self.init_buttons()
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.connect_sheets()), asyncio.create_task(self.matchmaker()),
+                          asyncio.create_task(self.maintain_journal()), asyncio.create_task(self.publish_queue_status())]
+
+    def stop(self):
+        if self.worker:
+            self.worker.stop()
+
+    # Run an engine method here or in the worker
+    async def engine_call(self, method, *args):
+        if self.worker:
+            return await self.worker.call(method, *args)
+        return getattr(self.engine, method)(*args)
+
+    async def init_buttons(self):
+        # Initialize matchmaking buttons
+
+        new_view = View(timeout=None)
+
+        for i in range(len(self.modes)):
+            button = Button(label=self.modes[i], style=ButtonStyle.blurple)
+
+            async def press(interaction, mode=self.modes[i]):
+                await interaction.response.defer()
+                await self.enter_queue(interaction, mode)
+                await interaction.followup.send("You have entered the " + mode + " queue.", ephemeral=True)
+
+            button.callback = press
+            new_view.add_item(button)
+
+        dequeue_button = Button(label="Leave Queue", style=ButtonStyle.red)
+
+        async def dequeue_press(interaction):
+            await interaction.response.defer()
+            await self.exit_queue(interaction)
+            await interaction.followup.send("You have left the matchmaking queue.", ephemeral=True)
+
+        dequeue_button.callback = dequeue_press
+
+        feedback_button = Button(label="Give Feedback", style=ButtonStyle.url, url=FEEDBACK_URL)
+
+        new_view.add_item(dequeue_button)
+        new_view.add_item(feedback_button)
+        channel = self.bot.get_channel(self.button_channel_id)
+        history = channel.history()
+        async for m in history:
+            if m.author == self.bot.user:
+                await m.delete()
+
+        self.mm_message = await channel.send("Matchmaking queue initialized! Press buttons below to search for a game.",
+                                             view=new_view)
+        self.mm_message_status = None
+        # Show anyone put back in the queue from the journal
+        await self.update_queue_status()
+
+    # A player enters the matchmaking queue
+    # If they are in the queue already, it will refresh their presence in the queue
+    # You can also move from one queue to another with this
+    async def enter_queue(self, interaction, game_type):
+        # put player in queue and check for match
+        with match_search_seconds.time(self.name, "join"):
+            events = await self.engine_call("join", str(interaction.user.id), interaction.user.name, game_type)
+        await self.apply_events(events)
+        self.queue_changed.set()
+
+        await self.update_queue_status()
+
+    # A player removes themselves from the queue
+    # If they aren't in the queue, it will just update the queue status
+    async def exit_queue(self, interaction):
+        await self.apply_events(await self.engine_call("leave", str(interaction.user.id)))
+        self.queue_changed.set()
+        await self.update_queue_status()
+
+    # Re-checks the queue whenever something could have changed: someone joined or left, a search range
+    # grew to reach a new opponent, an opponent passed the minimum queue time, or a reminder is due.
+    # Sleeps until the earliest of those instead of polling
+    async def matchmaker(self):
+        while True:
+            self.queue_changed.clear()
+            events = []
+            try:
+                with match_search_seconds.time(self.name, "refresh"):
+                    events = await self.engine_call("refresh")
+                await self.apply_events(events)
+            except Exception:
+                logging.exception("Queue refresh failed for " + self.name)
+            # Without batch pairing a refresh stops at the first match, and the deadlines only cover pairs
+            # that become possible later, so check again straight away for any that can be made now
+            if any(isinstance(event, matchmaking_engine.Matched) for event in events):
+                await asyncio.sleep(0)
+                continue
+
+            timeout = MATCHMAKER_IDLE_TIMEOUT
+            try:
+                deadlines = await self.engine_call("deadlines", time.time())
+            except Exception:
+                logging.exception("Queue deadlines failed for " + self.name)
+                deadlines = []
+            if deadlines:
+                timeout = min(timeout, max(deadlines[0][0] - time.time(), 0) + DEADLINE_MARGIN)
+            try:
+                await asyncio.wait_for(self.queue_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    # Carry out what the engine decided: journal and log queue changes, announce matches and send reminders
+    async def apply_events(self, events):
+        for event in events:
+            if isinstance(event, matchmaking_engine.Joined):
+                entry = event.entry
+                self.journal.enqueue(entry)
+                event_log.log_event("enqueue", shard=self.name, player_id=entry.player_id, game_type=entry.game_type,
+                                    rating=entry.rating)
+            elif isinstance(event, matchmaking_engine.Left):
+                entry = event.entry
+                self.journal.dequeue(entry.player_id)
+                event_log.log_event("dequeue", shard=self.name, player_id=entry.player_id, game_type=entry.game_type,
+                                    rating=entry.rating, waited=round(event.time - entry.time, 1))
+            elif isinstance(event, matchmaking_engine.Matched):
+                self.announce_matches(event)
+                await self.update_queue_status()
+            elif isinstance(event, matchmaking_engine.Reminder):
+                self.send_reminder(event.entry)
+
+    # Queue one message announcing a batch of matches and log them
+    # The engine has already taken the players out of the queue, so nobody can be matched twice while we wait on Discord
+    def announce_matches(self, event):
+        matches = event.matches
+        lines = ["We have a " + entry.game_type + " match! <@" + entry.player_id + "> vs <@" + opponent.player_id +
+                 ">." for entry, opponent in matches]
+        # A big batch of matches is split over as many messages as it takes to stay under MESSAGE_LIMIT
+        footer = " Find matches in <#" + str(self.button_channel_id) + ">"
+        announcements = [lines[0]]
+        for line in lines[1:]:
+            if len(announcements[-1]) + 1 + len(line) + len(footer) > MESSAGE_LIMIT:
+                announcements.append(line)
+            else:
+                announcements[-1] += "\n" + line
+        for part, announcement in enumerate(announcements):
+            self.notifier.channel_message(self.match_channel_id, announcement + footer,
+                                          key=("match", self.name, self.match_count, part))
+        now = event.time
+        for entry, opponent in matches:
+            event_log.log_event("match", shard=self.name, match_number=self.match_count, game_type=entry.game_type,
+                                player_id=entry.player_id, name=entry.name, rating=entry.rating,
+                                waited=round(now - entry.time, 1), opponent_id=opponent.player_id,
+                                opponent_name=opponent.name, opponent_rating=opponent.rating,
+                                opponent_waited=round(now - opponent.time, 1))
+            time_to_match.observe(now - entry.time, self.name, entry.game_type)
+            time_to_match.observe(now - opponent.time, self.name, opponent.game_type)
+            matches_made.inc(self.name, entry.game_type)
+            self.match_count += 1
+            self.journal.match(entry.player_id, opponent.player_id, self.match_count)
+
+    # Ping the role for a player's mode (first reminder), or DM them (second reminder)
+    # The engine only hands out each reminder once per time in the queue, and the key stops it being queued twice
+    def send_reminder(self, entry):
+        self.journal.reminder(entry)
+        key = ("reminder", self.name, entry.player_id, entry.time, entry.reminders)
+        if entry.reminders == 1:
+            role_id = "<@&" + str(self.role_ids[entry.game_type]) + ">"
+            self.notifier.channel_message(self.match_channel_id,
+                                          "There is a player looking for a match in queue! " + role_id, key=key)
+        else:
+            self.notifier.direct_message(entry.player_id, "You have been in the queue for 15 minutes. Please leave the queue if you have found a match or are no longer looking.",
+                                         key=key)
+
+    # Opens the spreadsheet once the bot is running, retrying until Google is reachable, then keeps
+    # the store synced with it
+    async def connect_sheets(self):
+        started = time.perf_counter()
+        while not self.ladder_sheets:
+            try:
+                self.ladder_sheets.update(await api.run_sheets(open_ladder_sheets, self.spreadsheet_key,
+                                                               self.ladder_worksheets))
+            except Exception:
+                logging.exception("Couldn't open the ratings spreadsheet for " + self.name)
+                await asyncio.sleep(SHEETS_RETRY_DELAY)
+        for ladder in self.ladder_sheets:
+            self.log_tails[ladder] = ratings.LogTail(self.ladder_sheets[ladder][1], *self.rating_store.tail_position(ladder))
+        self.startup_timings[self.name + " open spreadsheet"] = time.perf_counter() - started
+
+        first_sync = True
+        while True:
+            started = time.perf_counter()
+            await self.refresh_api_data()
+            if first_sync:
+                first_sync = False
+                self.startup_timings[self.name + " first Sheets sync"] = time.perf_counter() - started
+                print("Startup timings: " + ", ".join(phase + " " + "{:.3f}".format(self.startup_timings[phase]) + "s"
+                                                      for phase in self.startup_timings))
+            await asyncio.sleep(SHEETS_REFRESH_INTERVAL)
+
+    # update spreadsheet API data
+    async def refresh_api_data(self):
+        # The Sheets calls run on the thread pool, results are stored back here on the event loop
+        # Only the games logged since the last refresh are downloaded
+        # If Sheets is down the bot carries on with the ratings it already has
+        with sheets_refresh_seconds.time(self.name):
+            for ladder in self.ladder_sheets:
+                if ladder in self.ladder_reads and not self.ladder_reads[ladder].done():
+                    logging.warning("Still reading the " + ladder + " ladder from Sheets for " + self.name)
+                    continue
+                read_stars = (ladder not in self.stars_read_times
+                              or time.monotonic() - self.stars_read_times[ladder] >= STARS_READ_INTERVAL)
+                self.ladder_reads[ladder] = api.sheets_executor.submit(self.read_ladder_sheets, ladder, read_stars)
+                try:
+                    await self.store_ladder_data(ladder, *await api.wait_sheets(self.ladder_reads[ladder]))
+                except Exception:
+                    logging.exception("Couldn't refresh the " + ladder + " ladder from Sheets for " + self.name)
+
+    # Read a ladder's newly logged games from the spreadsheet, and its STARS players and ratings if there
+    # are any new games or read_stars is set (ratings only change when games are logged)
+    # Blocking, so this goes on the Sheets thread pool
+    # return: player -> rating from the STARS sheet (None if it wasn't read), then what
+    # LogTail.read_new_rows returns
+    def read_ladder_sheets(self, ladder, read_stars):
+        rows, full_sync, position = self.log_tails[ladder].read_new_rows()
+        ladder_players = None
+        if read_stars or rows:
+            player_column, rating_column = (ratings.column_letter(col) for col in self.stars_columns)
+            player_cells, rating_cells = self.ladder_sheets[ladder][0].batch_get(
+                [player_column + "2:" + player_column, rating_column + "2:" + rating_column])
+            ladder_players = ratings.stars_players([row[0] if row else "" for row in player_cells],
+                                                   [row[0] if row else "" for row in rating_cells])
+        return ladder_players, rows, full_sync, position
+
+    # Save what was read from a ladder's sheets in the store, and move the players whose rating changed
+    # Only those players are written to the store and sent to the worker, most refreshes change a few or none
+    # The ladder's tail only moves past the new rows once they're stored
+    async def store_ladder_data(self, ladder, ladder_players, rows, full_sync, position):
+        changes = []
+        if ladder_players is not None:
+            changes = self.percentile_engines[ladder].update(ladder_players)
+            self.stars_read_times[ladder] = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(self.store_writer, self.write_ladder_data, ladder,
+                                                         changes, rows, full_sync, position)
+        self.log_tails[ladder].advance(position)
+        if self.worker and changes:
+            await self.worker.call("apply_ladder_changes", ladder, changes)
+
+    # Save a ladder's changed STARS players and new Logs rows in the store
+    # Runs on the store writer thread
+    def write_ladder_data(self, ladder, changes, rows, full_sync, position):
+        if changes:
+            self.rating_store.apply_ladder_changes(ladder, changes)
+        self.rating_store.apply_logs(ladder, rows, full_sync, *position)
+
+    # Fsyncs the queue journal in batches, and compacts it once it's grown enough
+    async def maintain_journal(self):
+        while True:
+            await asyncio.sleep(QUEUE_JOURNAL_SYNC_INTERVAL)
+            try:
+                await asyncio.to_thread(self.journal.sync)
+                if self.journal.needs_compacting():
+                    self.journal.compact(self.queue, self.match_count)
+            except OSError:
+                logging.exception("Queue journal maintenance failed for " + self.name)
+
+    # Update message with the current queue status
+    # Only flags the message as out of date, publish_queue_status does the actual edit
+    async def update_queue_status(self):
+        self.status_changed.set()
+
+    # Edits the queue status message when it's out of date, at most once every STATUS_EDIT_INTERVAL seconds
+    # Changes made in between are rolled into the next edit, and edits that wouldn't change the text are skipped
+    async def publish_queue_status(self):
+        while True:
+            await self.status_changed.wait()
+            self.status_changed.clear()
+            new_message = self.queue_status()
+            if new_message != self.mm_message_status:
+                try:
+                    with status_edit_seconds.time(self.name):
+                        await self.mm_message.edit(content=new_message)
+                    self.mm_message_status = new_message
+                except discord.HTTPException:
+                    logging.exception("Queue status edit failed for " + self.name)
+                    self.status_changed.set()
+            await asyncio.sleep(STATUS_EDIT_INTERVAL)
+
+    # The queue status message text
+    def queue_status(self):
+        new_message = "There are " + str(len(self.queue)) + " users in the matchmaking queue ("
+        for mode in self.modes:
+            new_message += str(self.queue.count(mode)) + " " + mode + ", "
+        return new_message[:-2] + ")"
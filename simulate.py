@@ -0,0 +1,339 @@
+# file: simulate.py
+# Offline matchmaking simulator. Drives the matchmaking engine with synthetic ladders and Poisson
+# arrivals and departures on a fake clock, so changes to matchmaking can be tried at any queue
+# size without going live. Nothing here talks to Discord or Sheets
+# usage: python simulate.py [--arrivals 20] [--initial 0] [--minutes 120] [--seed 1] [--widening adaptive]
+#        python simulate.py --compare-widening [--arrivals 20] ...
+#        python simulate.py --bench [--baseline bench.json] [--save-baseline]
+# --bench fails if a scenario's matches, median wait, median rating gap or average queue size differ from
+# bench.json (the seeds are fixed, so they only change when matchmaking does: check the change was meant and
+# save a new baseline), or if it got more than BENCH_TOLERANCE slower. Times are compared relative to a fixed calibration workload
+# timed on the same machine, so a baseline saved on one machine still works on another
+
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+
+import matchmaking_engine
+import matchmaking_queue
+import ratings
+
+# Share of players queueing for each mode
+MODE_WEIGHTS = (0.6, 0.15, 0.25)
+# Size and shape of the synthetic ladders, as (number of players, mean rating, standard deviation)
+LADDER_SHAPES = {"OFF": (2000, 1500, 200), "ON": (800, 1450, 180)}
+# Share of players who aren't on the ladder yet and queue at the default rating
+NEW_PLAYER_SHARE = 0.1
+DEFAULT_RATING = 1400
+# The queue is refreshed like the bot's matchmaker does it (see shard.py): whenever someone joins or leaves,
+# again straight away after a refresh that made a match, and otherwise at the engine's next deadline (plus a
+# margin), or after an idle timeout if nothing is due
+IDLE_TIMEOUT = 60
+DEADLINE_MARGIN = 0.05
+# How far back the join times of the players already queued at the start are spread
+INITIAL_JOIN_SPREAD = 240
+# Rating gap buckets for the report
+GAP_BUCKETS = (25, 50, 100, 200, 400)
+
+# Settings for bench scenarios that hold a queue at the size it starts at: patient players, narrow search
+# ranges that grow slowly, and ratings spread out enough that few players share one, so arrivals are rarely
+# matched and the bench keeps measuring refreshes of a queue that size
+CROWDED_QUEUE = {"patience": 1800, "range_growth_time": 900,
+                 "ladder_shapes": {"OFF": (2000, 1500, 600), "ON": (800, 1450, 540)}}
+# Scenarios run by --bench, as keyword arguments for Simulation
+BENCH_SCENARIOS = {
+    "20 per minute": {"arrivals": 20, "minutes": 60},
+    "500 at the start": {"initial": 500, "arrivals": 100, "minutes": 30},
+    "50 queued": dict(CROWDED_QUEUE, initial=50, arrivals=6, minutes=30, percentile_range=0.002),
+    "500 queued": dict(CROWDED_QUEUE, initial=500, arrivals=200, minutes=2, percentile_range=0.0002),
+    "500 queued, first match": dict(CROWDED_QUEUE, initial=500, arrivals=200, minutes=2, percentile_range=0.0002,
+                                    batch_pairing=False),
+}
+# How much slower than the baseline a scenario can get before --bench fails
+BENCH_TOLERANCE = 0.5
+# Times each scenario and the calibration are run, keeping the fastest, to smooth out noise
+BENCH_REPEATS = 3
+# Results that have to match the baseline exactly
+BENCH_EXACT_KEYS = ("matches", "wait_p50", "gap_p50", "avg_queue_size")
+
+
+# Stands in for time.time(), only moving when the simulation moves it
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def make_ladder(rng, size, mean, spread):
+    return [max(1, round(rng.gauss(mean, spread))) for _ in range(size)]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Simulation:
+    # arrivals: players joining per minute, initial: players already in the queue at the start,
+    # patience: average seconds a player waits before giving up and leaving the queue
+    # engine_settings: keyword arguments for the engine, e.g. percentile_range and range_growth_time
+    def __init__(self, seed=1, arrivals=20, initial=0, minutes=120, patience=900, batch_pairing=True,
+                 mode_weights=MODE_WEIGHTS, ladder_shapes=LADDER_SHAPES, **engine_settings):
+        self.rng = random.Random(seed)
+        self.clock = FakeClock()
+        self.arrivals = arrivals
+        self.initial = initial
+        self.duration = minutes * 60
+        self.patience = patience
+        self.mode_weights = mode_weights
+
+        self.ladders = {ladder: make_ladder(self.rng, *ladder_shapes[ladder]) for ladder in ladder_shapes}
+        self.percentile_engines = {ladder: ratings.PercentileEngine(dict(enumerate(self.ladders[ladder])))
+                                   for ladder in self.ladders}
+        # Rating of the player about to join, handed to the engine when it asks for it
+        self.joining_rating = None
+        self.engine = matchmaking_engine.MatchmakingEngine(self, self.clock.time, batch_pairing=batch_pairing,
+                                                           **engine_settings)
+        self.queue = self.engine.queue
+
+        # Heap of (time, sequence number, event, player_id)
+        self.events = []
+        self.next_player = 0
+        self.sequence = 0
+        # (time, sequence number) of the refresh the matchmaker is waiting for, any others scheduled are dropped
+        self.next_refresh = None
+
+        self.waits = []
+        self.gaps = []
+        self.left = 0
+        self.reminders = 0
+        self.refresh_seconds = []
+        self.join_seconds = []
+        self.queue_sizes = []
+
+    def schedule(self, at, event, player_id=None):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, event, player_id))
+
+    # Wake the matchmaker at a time, unless it's already due to wake before then
+    def schedule_refresh(self, at):
+        if self.next_refresh is not None and self.next_refresh[0] <= at:
+            return
+        self.schedule(at, "refresh")
+        self.next_refresh = (at, self.sequence)
+
+    def run(self):
+        for _ in range(self.initial):
+            # Spread the starting queue over the last few minutes, so not everyone has waited the same time
+            self.join(self.clock.now - self.rng.uniform(0, INITIAL_JOIN_SPREAD), check=False)
+        if self.arrivals:
+            self.schedule(self.rng.expovariate(self.arrivals / 60), "arrive")
+        self.schedule_refresh(0)
+
+        while self.events and self.events[0][0] <= self.duration:
+            self.clock.now, sequence, event, player_id = heapq.heappop(self.events)
+            if event == "arrive":
+                started = time.perf_counter()
+                self.join(self.clock.now)
+                self.join_seconds.append(time.perf_counter() - started)
+                self.schedule(self.clock.now + self.rng.expovariate(self.arrivals / 60), "arrive")
+                self.schedule_refresh(self.clock.now)
+            elif event == "leave":
+                if self.engine.leave(player_id):
+                    self.left += 1
+                    self.schedule_refresh(self.clock.now)
+            elif event == "refresh" and self.next_refresh == (self.clock.now, sequence):
+                self.next_refresh = None
+                self.refresh()
+        return self.report()
+
+    # One wake of the matchmaker: refresh the queue, then work out when to next wake
+    def refresh(self):
+        self.queue_sizes.append(len(self.queue))
+        started = time.perf_counter()
+        events = self.engine.refresh()
+        if any(isinstance(event, matchmaking_engine.Matched) for event in events):
+            self.schedule_refresh(self.clock.now)
+        else:
+            wake = self.clock.now + IDLE_TIMEOUT
+            deadlines = self.engine.deadlines(self.clock.now)
+            if deadlines:
+                wake = min(wake, max(deadlines[0][0], self.clock.now) + DEADLINE_MARGIN)
+            self.schedule_refresh(wake)
+        self.refresh_seconds.append(time.perf_counter() - started)
+        self.apply_events(events)
+
+    # A new player presses a queue button
+    # Players already queued at the start are put straight in the queue with an earlier join time
+    def join(self, join_time, check=True):
+        self.next_player += 1
+        player_id = str(self.next_player)
+        game_type = self.rng.choices(matchmaking_engine.mode_list, self.mode_weights)[0]
+        if self.rng.random() < NEW_PLAYER_SHARE:
+            self.joining_rating = DEFAULT_RATING
+        else:
+            self.joining_rating = self.rng.choice(self.ladders[matchmaking_engine.rating_ladder(game_type)])
+        # Patience is exponential, so a player already queued at the start has as long left as a new one
+        self.schedule(max(join_time, self.clock.now) + self.rng.expovariate(1 / self.patience), "leave", player_id)
+        if check:
+            self.apply_events(self.engine.join(player_id, player_id, game_type))
+        else:
+            self.queue.add(matchmaking_queue.QueueEntry(player_id, player_id, self.joining_rating, join_time,
+                                                        game_type))
+
+    def apply_events(self, events):
+        for event in events:
+            if isinstance(event, matchmaking_engine.Matched):
+                for entry, opponent in event.matches:
+                    self.waits += [event.time - entry.time, event.time - opponent.time]
+                    self.gaps.append(abs(entry.rating - opponent.rating))
+            elif isinstance(event, matchmaking_engine.Reminder):
+                self.reminders += 1
+
+    # Rating provider for the engine
+    def player_rating(self, game_type, player_id):
+        return self.joining_rating
+
+    def percentile_engine(self, game_type):
+        return self.percentile_engines[matchmaking_engine.rating_ladder(game_type)]
+
+    def report(self):
+        gap_counts = {}
+        for bucket in GAP_BUCKETS + (None,):
+            gap_counts["<=" + str(bucket) if bucket else ">" + str(GAP_BUCKETS[-1])] = 0
+        for gap in self.gaps:
+            for bucket in GAP_BUCKETS:
+                if gap <= bucket:
+                    gap_counts["<=" + str(bucket)] += 1
+                    break
+            else:
+                gap_counts[">" + str(GAP_BUCKETS[-1])] += 1
+
+        return {"matches": len(self.gaps),
+                "matches_per_hour": len(self.gaps) / (self.duration / 3600),
+                "left_unmatched": self.left,
+                "reminders": self.reminders,
+                "still_queued": len(self.queue),
+                "avg_queue_size": sum(self.queue_sizes) / len(self.queue_sizes),
+                "wait_p50": percentile(self.waits, 0.5),
+                "wait_p99": percentile(self.waits, 0.99),
+                "gap_p50": percentile(self.gaps, 0.5),
+                "gap_p99": percentile(self.gaps, 0.99),
+                "gaps": gap_counts,
+                "refreshes": len(self.refresh_seconds),
+                "refresh_ms_p50": percentile(self.refresh_seconds, 0.5) * 1000,
+                "refresh_ms_p99": percentile(self.refresh_seconds, 0.99) * 1000,
+                "refresh_ms_max": max(self.refresh_seconds) * 1000,
+                "join_ms_p99": percentile(self.join_seconds, 0.99) * 1000,
+                "cpu_seconds": sum(self.refresh_seconds) + sum(self.join_seconds)}
+
+
+def print_report(report):
+    for key in report:
+        value = report[key]
+        if isinstance(value, float):
+            value = "{:.3f}".format(value)
+        elif isinstance(value, dict):
+            value = ", ".join(bucket + ": " + str(value[bucket]) for bucket in value)
+        print("  " + key + ": " + str(value))
+
+
+# Seconds this machine takes over a fixed bit of plain Python that doesn't touch matchmaking
+def calibrate():
+    rng = random.Random(0)
+    values = [rng.random() for _ in range(100000)]
+    started = time.perf_counter()
+    total = 0
+    for value in sorted(values):
+        total += value * value
+    return time.perf_counter() - started
+
+
+# Run every bench scenario and compare it to a saved baseline
+# return: True if nothing changed and nothing got slower than BENCH_TOLERANCE allows
+def bench(baseline_path, save_baseline):
+    results = {}
+    # Calibrated between every run, so a stretch of the machine being busy affects both the same way
+    calibrations = []
+    for name in BENCH_SCENARIOS:
+        print(name)
+        runs = []
+        for _ in range(BENCH_REPEATS):
+            calibrations.append(calibrate())
+            runs.append(Simulation(**BENCH_SCENARIOS[name]).run())
+        results[name] = min(runs, key=lambda report: report["cpu_seconds"])
+        print_report(results[name])
+    results["calibration_seconds"] = min(calibrations)
+
+    if save_baseline:
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("Saved baseline to " + baseline_path)
+        return True
+
+    try:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print("FAILED: no baseline at " + baseline_path + ", run with --save-baseline to make one")
+        return False
+
+    passed = True
+    # How much faster or slower this machine is than the one the baseline was saved on
+    speed = results["calibration_seconds"] / baseline["calibration_seconds"]
+    for name in BENCH_SCENARIOS:
+        if name not in baseline:
+            print("FAILED: " + name + " isn't in the baseline, save a new one")
+            passed = False
+            continue
+        old, new = baseline[name], results[name]
+        if new["cpu_seconds"] > old["cpu_seconds"] * speed * (1 + BENCH_TOLERANCE):
+            print("SLOWER: " + name + " took " + "{:.3f}".format(new["cpu_seconds"]) + "s, baseline " +
+                  "{:.3f}".format(old["cpu_seconds"] * speed) + "s on this machine")
+            passed = False
+        # Same seed, so any difference here means matchmaking itself behaves differently
+        for key in BENCH_EXACT_KEYS:
+            if new[key] != old[key]:
+                print("CHANGED: " + name + " " + key + " " + str(old[key]) + " -> " + str(new[key]))
+                passed = False
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the matchmaking queue offline")
+    parser.add_argument("--arrivals", type=float, default=20, help="players joining per minute")
+    parser.add_argument("--initial", type=int, default=0, help="players in the queue at the start")
+    parser.add_argument("--minutes", type=float, default=120, help="simulated minutes")
+    parser.add_argument("--patience", type=float, default=900, help="average seconds before a player gives up")
+    parser.add_argument("--first-match", action="store_true", help="stop at the first match on each refresh")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--widening", choices=list(matchmaking_engine.WIDENING_POLICIES), default="linear",
+                        help="how search ranges grow with time in the queue")
+    parser.add_argument("--compare-widening", action="store_true",
+                        help="run the same players through every widening policy")
+    parser.add_argument("--bench", action="store_true", help="run the benchmark scenarios")
+    parser.add_argument("--baseline", default="bench.json", help="benchmark results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="save the benchmark results as the baseline")
+    args = parser.parse_args()
+
+    if args.bench:
+        sys.exit(0 if bench(args.baseline, args.save_baseline) else 1)
+
+    policies = list(matchmaking_engine.WIDENING_POLICIES) if args.compare_widening else [args.widening]
+    for widening in policies:
+        if args.compare_widening:
+            print(widening)
+        # Same seed for every policy, so they all see the same arrivals
+        print_report(Simulation(args.seed, args.arrivals, args.initial, args.minutes, args.patience,
+                                not args.first_match, widening=widening).run())
+
+
+if __name__ == "__main__":
+    main()
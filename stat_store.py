@@ -0,0 +1,127 @@
+# file: stat_store.py
+# Local copy of everyone's Project Rio batting and pitching totals, for every user on every character
+# It's pulled in bulk every so often, and stat lookups then add up the rows they need in SQLite
+# (one SUM query) and run the usual formulas from stats.py on them, instead of asking Rio each time
+# Only the counting stats the formulas need are kept
+
+import logging
+import sqlite3
+import time
+
+import characters
+
+# The counting stats kept for each kind of stats, as they're named in detailed_stats responses
+COLUMNS = {
+    "Batting": ("summary_at_bats", "summary_hits", "summary_singles", "summary_doubles", "summary_triples",
+                "summary_homeruns", "summary_walks_bb", "summary_walks_hbp", "summary_sac_flys"),
+    "Pitching": ("batters_faced", "outs_pitched", "runs_allowed", "hits_allowed", "walks_bb", "walks_hbp",
+                 "strikeouts_pitched"),
+}
+
+
+# Rows for one kind of stats from a detailed_stats response grouped by user and character
+# (&by_user=1&by_char=1), which looks like {"Stats": {user: {character: {"Batting": {...}}}}}
+# Characters can be IDs, or names spelled exactly as a name or alias (ignoring case and punctuation)
+# Names aren't guessed at like they are in commands, since a wrong guess would file one character's stats
+# under another. Any that aren't recognised are logged and skipped
+# return: list of (user, char_id, stats)
+def parse_grouped_stats(response, kind):
+    rows = []
+    unknown = set()
+    for user, by_char in response.get("Stats", {}).items():
+        for char, char_stats in by_char.items():
+            stats = char_stats.get(kind)
+            if not stats:
+                continue
+            if str(char).isdigit():
+                char_id = int(char)
+            elif char in characters.reverse_mappings:
+                char_id = characters.reverse_mappings[char]
+            elif characters.normalize(char) in characters.alias_index:
+                char_id = characters.alias_index[characters.normalize(char)].char_id
+            else:
+                unknown.add(char)
+                continue
+            if char_id is not None:
+                rows.append((user, char_id, stats))
+    if unknown:
+        logging.warning("Skipped " + kind + " stats for unknown characters: " + ", ".join(sorted(map(str, unknown))))
+    return rows
+
+
+# SQL WHERE clause and arguments picking out one user and/or one character
+def stat_filters(user, char_id):
+    conditions = []
+    args = []
+    if user is not None:
+        conditions.append("user = ?")
+        args.append(user)
+    if char_id is not None:
+        conditions.append("char_id = ?")
+        args.append(char_id)
+    if not conditions:
+        return "", args
+    return " WHERE " + " AND ".join(conditions), args
+
+
+# Pulls are stored off the event loop, so the store can be used from any thread
+class StatStore:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            for kind in COLUMNS:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS " + kind + " (user TEXT NOT NULL COLLATE NOCASE, "
+                                        "char_id INTEGER NOT NULL, " +
+                                        ", ".join(column + " INTEGER NOT NULL" for column in COLUMNS[kind]) +
+                                        ", PRIMARY KEY (user, char_id))")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS " + kind + "_char ON " + kind + " (char_id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS synced (kind TEXT PRIMARY KEY, time REAL NOT NULL)")
+
+    # Replace every row of a kind of stats with a new pull (list of (user, char_id, stats))
+    # Written through a connection of its own, so lookups keep seeing the last pull until this one is committed
+    def replace(self, kind, rows):
+        columns = COLUMNS[kind]
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                connection.execute("DELETE FROM " + kind)
+                connection.executemany("INSERT OR REPLACE INTO " + kind + " VALUES (?, ?" + ", ?" * len(columns) + ")",
+                                       [(user, char_id) + tuple(stats.get(column, 0) for column in columns)
+                                        for user, char_id, stats in rows])
+                connection.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (kind, time.time()))
+        finally:
+            connection.close()
+
+    # When a kind of stats was last pulled, or None if it never has been
+    def synced(self, kind):
+        row = self.connection.execute("SELECT time FROM synced WHERE kind = ?", (kind,)).fetchone()
+        return None if row is None else row[0]
+
+    # Totals of a kind of stats, for one user or everyone (user None) on one character or all of them (char_id None)
+    # return: dict of stat name -> total, empty if there are no games, like detailed_stats returns
+    def totals(self, kind, user=None, char_id=None):
+        where, args = stat_filters(user, char_id)
+        row = self.connection.execute("SELECT COUNT(*), " + ", ".join("SUM(" + column + ")" for column in COLUMNS[kind]) +
+                                      " FROM " + kind + where, args).fetchone()
+        if not row[0]:
+            return {}
+        return dict(zip(COLUMNS[kind], row[1:]))
+
+    # Totals of a kind of stats for every user, on one character or all of them
+    # return: dict of user -> dict of stat name -> total
+    def user_totals(self, kind, char_id=None):
+        where, args = stat_filters(None, char_id)
+        rows = self.connection.execute("SELECT user, " + ", ".join("SUM(" + column + ")" for column in COLUMNS[kind]) +
+                                       " FROM " + kind + where + " GROUP BY user", args)
+        return {row[0]: dict(zip(COLUMNS[kind], row[1:])) for row in rows}
+
+    # Something that changes whenever a character's stats do: their row count and totals
+    # return: dict of char_id -> fingerprint, with None for all characters together
+    def char_fingerprints(self, kind):
+        sums = ", ".join("SUM(" + column + ")" for column in COLUMNS[kind])
+        fingerprints = {row[0]: row[1:] for row in
+                        self.connection.execute("SELECT char_id, COUNT(*), " + sums + " FROM " + kind + " GROUP BY char_id")}
+        fingerprints[None] = self.connection.execute("SELECT COUNT(*), " + sums + " FROM " + kind).fetchone()
+        return fingerprints
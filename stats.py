@@ -0,0 +1,42 @@
+# file: stats.py
+# Batting and pitching stat lines from Project Rio detailed_stats summaries
+# stats is the player's summary and overall is the league summary they're compared against
+
+
+def batting_line(stats, overall):
+    pa = stats["summary_at_bats"] + stats["summary_walks_bb"] + stats["summary_walks_hbp"] + stats[
+        "summary_sac_flys"]
+    avg = stats["summary_hits"] / stats["summary_at_bats"]
+    obp = (stats["summary_hits"] + stats["summary_walks_hbp"] + stats["summary_walks_bb"]) / pa
+    slg = (stats["summary_singles"] + (stats["summary_doubles"] * 2) + (stats["summary_triples"] * 3) + (
+            stats["summary_homeruns"] * 4)) / stats["summary_at_bats"]
+    ops = obp + slg
+
+    overall_pa = overall["summary_at_bats"] + overall["summary_walks_bb"] + overall["summary_walks_hbp"] + overall[
+        "summary_sac_flys"]
+    overall_obp = (overall["summary_hits"] + overall["summary_walks_hbp"] + overall[
+        "summary_walks_bb"]) / overall_pa
+    overall_slg = (overall["summary_singles"] + (overall["summary_doubles"] * 2) + (
+            overall["summary_triples"] * 3) + (
+                           overall["summary_homeruns"] * 4)) / overall["summary_at_bats"]
+
+    ops_plus = ((obp / overall_obp) + (slg / overall_slg) - 1) * 100
+
+    return {"pa": pa, "avg": avg, "obp": obp, "slg": slg, "ops": ops, "ops_plus": ops_plus}
+
+
+def pitching_line(stats, overall):
+    # batter avg vs pitcher
+    d_avg = stats["hits_allowed"] / (stats["batters_faced"] - stats["walks_bb"] - stats["walks_hbp"])
+    era = 9 * stats["runs_allowed"] / (stats["outs_pitched"] / 3)
+    # strikeout percentage
+    kp = (stats["strikeouts_pitched"] / stats["batters_faced"]) * 100
+
+    ip = stats["outs_pitched"] // 3
+    ip_str = str(ip + (0.1 * (stats["outs_pitched"] % 3)))
+
+    overall_era = 9 * overall["runs_allowed"] / (overall["outs_pitched"] / 3)
+    # character ERA-
+    cera_minus = (era / overall_era) * 100
+
+    return {"ip": ip_str, "d_avg": d_avg, "era": era, "kp": kp, "era_minus": cera_minus}
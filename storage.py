@@ -0,0 +1,146 @@
+# file: storage.py
+# The bot's own copy of the ratings spreadsheet. Every rating lookup is answered from here and the
+# Google Sheet is only ever synced into it, so matchmaking keeps working when Sheets is slow or down
+# Ratings are kept per ladder ("OFF" for Superstars-Off, "ON" for Superstars-On)
+
+import json
+import sqlite3
+
+import ratings
+
+
+# Open the store for a backend name ("sqlite" or "memory")
+def open_store(backend, path):
+    if backend == "sqlite":
+        return SQLiteStore(path)
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError("Unknown storage backend " + backend)
+
+
+# Keeps everything in dicts and lists, so it starts empty every time the bot does
+class MemoryStore:
+    def __init__(self):
+        self.latest_ratings = {}
+        self.ladders = {}
+        self.logs = {}
+        self.tail_positions = {}
+
+    # A player's rating from their latest logged game
+    def latest_rating(self, ladder, player_id, default):
+        return self.latest_ratings.get(ladder, {}).get(player_id, default)
+
+    # Every player's rating from the ladder's STARS sheet, as player -> rating
+    def ladder_players(self, ladder):
+        return dict(self.ladders.get(ladder, {}))
+
+    # Apply a list of (player, new rating or None if they left the ladder)
+    def apply_ladder_changes(self, ladder, changes):
+        ladder_players = self.ladders.setdefault(ladder, {})
+        for player, rating in changes:
+            if rating is None:
+                ladder_players.pop(player, None)
+            else:
+                ladder_players[player] = rating
+
+    # Add rows read from a ladder's Logs sheet, replacing everything logged before if they're a full
+    # read of the sheet, and record how far down the sheet has now been read
+    def apply_logs(self, ladder, rows, full_sync, row_count, checksum):
+        if full_sync:
+            self.logs[ladder] = []
+        self.logs.setdefault(ladder, []).extend(rows)
+        ratings.apply_log_rows(self.latest_ratings.setdefault(ladder, {}), rows, full_sync)
+        self.tail_positions[ladder] = (row_count, checksum)
+
+    # How far down the Logs sheet has been read, as (row count, checksum of the last row)
+    def tail_position(self, ladder):
+        return self.tail_positions.get(ladder, (0, None))
+
+
+# Keeps everything in a SQLite database, so the ratings are still there after a restart
+# Lookups come from the event loop thread and writes from one writer thread at a time (the shard's store
+# writer). Writes go through a connection of their own, so while a write is under way lookups keep seeing
+# the last committed ratings instead of a half done resync
+class SQLiteStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        with self.writer:
+            self.writer.executescript("""
+                CREATE TABLE IF NOT EXISTS latest_ratings (
+                    ladder TEXT NOT NULL,
+                    player_id TEXT NOT NULL,
+                    rating INTEGER NOT NULL,
+                    PRIMARY KEY (ladder, player_id)
+                );
+                CREATE INDEX IF NOT EXISTS latest_ratings_player ON latest_ratings (player_id);
+                CREATE TABLE IF NOT EXISTS ladder_players (
+                    ladder TEXT NOT NULL,
+                    player TEXT NOT NULL,
+                    rating INTEGER NOT NULL,
+                    PRIMARY KEY (ladder, player)
+                );
+                CREATE TABLE IF NOT EXISTS logs (
+                    ladder TEXT NOT NULL,
+                    row_number INTEGER NOT NULL,
+                    cells TEXT NOT NULL,
+                    PRIMARY KEY (ladder, row_number)
+                );
+                CREATE TABLE IF NOT EXISTS tail_positions (
+                    ladder TEXT PRIMARY KEY,
+                    row_count INTEGER NOT NULL,
+                    checksum INTEGER
+                );
+            """)
+            # Older stores kept the ladders as bare ratings. Keep them under placeholder names until the
+            # first read of each STARS sheet replaces them with the real players
+            if self.writer.execute("SELECT 1 FROM sqlite_master WHERE name = 'ladder_ratings'").fetchone():
+                self.writer.execute("INSERT OR IGNORE INTO ladder_players "
+                                    "SELECT ladder, '(row ' || rowid || ')', rating FROM ladder_ratings")
+                self.writer.execute("DROP TABLE ladder_ratings")
+
+    def latest_rating(self, ladder, player_id, default):
+        row = self.connection.execute("SELECT rating FROM latest_ratings WHERE ladder = ? AND player_id = ?",
+                                      (ladder, player_id)).fetchone()
+        return default if row is None else row[0]
+
+    def ladder_players(self, ladder):
+        return dict(self.connection.execute("SELECT player, rating FROM ladder_players WHERE ladder = ?",
+                                            (ladder,)))
+
+    def apply_ladder_changes(self, ladder, changes):
+        with self.writer:
+            self.writer.executemany("DELETE FROM ladder_players WHERE ladder = ? AND player = ?",
+                                    [(ladder, player) for player, rating in changes if rating is None])
+            self.writer.executemany("INSERT OR REPLACE INTO ladder_players VALUES (?, ?, ?)",
+                                    [(ladder, player, rating) for player, rating in changes if rating is not None])
+
+    def apply_logs(self, ladder, rows, full_sync, row_count, checksum):
+        # One transaction, so the logs and the tail position can't get out of step
+        with self.writer:
+            if full_sync:
+                self.writer.execute("DELETE FROM logs WHERE ladder = ?", (ladder,))
+                self.writer.execute("DELETE FROM latest_ratings WHERE ladder = ?", (ladder,))
+                first_row = 1
+            else:
+                last_row = self.writer.execute("SELECT MAX(row_number) FROM logs WHERE ladder = ?",
+                                               (ladder,)).fetchone()[0]
+                first_row = (last_row or 0) + 1
+            self.insert_logs(ladder, rows, first_row)
+            self.writer.execute("INSERT OR REPLACE INTO tail_positions VALUES (?, ?, ?)",
+                                (ladder, row_count, checksum))
+
+    def insert_logs(self, ladder, rows, first_row):
+        self.writer.executemany("INSERT INTO logs VALUES (?, ?, ?)",
+                                [(ladder, first_row + i, json.dumps(row)) for i, row in enumerate(rows)])
+        new_ratings = ratings.index_log_rows(rows, {})
+        self.writer.executemany("INSERT OR REPLACE INTO latest_ratings VALUES (?, ?, ?)",
+                                [(ladder, player_id, new_ratings[player_id]) for player_id in new_ratings])
+
+    def tail_position(self, ladder):
+        row = self.connection.execute("SELECT row_count, checksum FROM tail_positions WHERE ladder = ?",
+                                      (ladder,)).fetchone()
+        return (0, None) if row is None else row
@@ -0,0 +1,85 @@
+# file: test_matchmaking.py
+# Randomized checks that the matchmaker's deadlines are right: refreshing the queue any time before the
+# first deadline changes nothing, and refreshing it just after makes the match or sends the reminder it predicted
+# run with: python -m pytest
+
+import random
+
+import pytest
+
+import matchmaking_engine
+import matchmaking_queue
+import ratings
+import simulate
+
+
+# Rating provider with fixed ladders and a rating for each player
+class FixedRatings:
+    def __init__(self, rng):
+        self.ladders = {ladder: ratings.PercentileEngine(dict(enumerate(simulate.make_ladder(rng, 300, 1500, 200))))
+                        for ladder in ("OFF", "ON")}
+        self.player_ratings = {}
+
+    def player_rating(self, game_type, player_id):
+        return self.player_ratings[player_id]
+
+    def percentile_engine(self, game_type):
+        return self.ladders[matchmaking_engine.rating_ladder(game_type)]
+
+
+# An engine with a few players who joined at random times over the last few minutes, none of them matched yet
+def random_queue(rng, clock, batch_pairing, widening):
+    provider = FixedRatings(rng)
+    engine = matchmaking_engine.MatchmakingEngine(provider, clock.time, batch_pairing=batch_pairing,
+                                                  widening=widening)
+    for player in range(rng.randint(2, 8)):
+        player_id = str(player)
+        provider.player_ratings[player_id] = round(rng.gauss(1500, 300))
+        clock.now = rng.uniform(0, 240)
+        game_type = rng.choice(matchmaking_engine.mode_list)
+        # Joining with the starting range would match some of them straight away, so they go straight in
+        engine.queue.add(matchmaking_queue.QueueEntry(player_id, player_id, provider.player_ratings[player_id],
+                                                      clock.now, game_type))
+        engine.widening.joined(engine.queue[player_id], clock.now)
+    clock.now = 240
+    return engine
+
+
+@pytest.mark.parametrize("batch_pairing", [True, False])
+def test_nothing_happens_before_the_first_deadline(batch_pairing):
+    rng = random.Random(1)
+    for _ in range(300):
+        clock = simulate.FakeClock()
+        engine = random_queue(rng, clock, batch_pairing, "linear")
+        # Catch up on whatever is already possible, as the matchmaker does when it wakes
+        while any(isinstance(event, matchmaking_engine.Matched) for event in engine.refresh()):
+            pass
+        deadlines = engine.deadlines(clock.now)
+        if not deadlines:
+            continue
+        first = deadlines[0][0]
+        for wake in sorted(rng.uniform(clock.now, first) for _ in range(5)):
+            clock.now = wake
+            if wake < first:
+                assert engine.refresh() == []
+
+
+@pytest.mark.parametrize("widening", list(matchmaking_engine.WIDENING_POLICIES))
+@pytest.mark.parametrize("batch_pairing", [True, False])
+def test_first_deadline_is_met(batch_pairing, widening):
+    rng = random.Random(2)
+    for _ in range(300):
+        clock = simulate.FakeClock()
+        engine = random_queue(rng, clock, batch_pairing, widening)
+        while any(isinstance(event, matchmaking_engine.Matched) for event in engine.refresh()):
+            pass
+        deadlines = engine.deadlines(clock.now)
+        if not deadlines:
+            continue
+        first, description = deadlines[0]
+        clock.now = first + simulate.DEADLINE_MARGIN
+        events = engine.refresh()
+        if description.endswith(" pairing"):
+            assert any(isinstance(event, matchmaking_engine.Matched) for event in events)
+        else:
+            assert any(isinstance(event, matchmaking_engine.Reminder) for event in events)
@@ -0,0 +1,101 @@
+# file: test_ratings.py
+# Randomized checks of PercentileEngine against the search range calculation the bot used to do,
+# which copied the ladder, added the player's rating and the sentinels, and sorted it for every lookup
+# run with: python -m pytest
+
+import random
+
+import ratings
+
+
+def old_search_range(ladder_ratings, rating, percentile):
+    rating_list_copy = list(ladder_ratings)
+    rating_list_copy.append(rating)
+    rating_list_copy.append(ratings.MIN_SENTINEL_RATING)
+    rating_list_copy.append(ratings.MAX_SENTINEL_RATING)
+    pct_list = sorted(rating_list_copy, reverse=True)
+    max_index = round(pct_list.index(rating) - (len(pct_list) * percentile))
+    min_index = round(pct_list.index(rating) + (len(pct_list) * percentile))
+    if max_index < 0:
+        max_index = 0
+    if min_index >= len(pct_list):
+        min_index = len(pct_list) - 1
+    return pct_list[min_index], pct_list[max_index]
+
+
+def random_ladder(rng):
+    return [rng.randint(1, 2999) if rng.random() < 0.2 else round(rng.gauss(1500, 200))
+            for _ in range(rng.randint(0, 300))]
+
+
+def random_rating(rng, ladder_ratings):
+    if ladder_ratings and rng.random() < 0.5:
+        return rng.choice(ladder_ratings)
+    return rng.randint(1, 2999)
+
+
+def test_search_range_matches_sorting():
+    rng = random.Random(1)
+    for _ in range(300):
+        ladder_ratings = random_ladder(rng)
+        engine = ratings.PercentileEngine(dict(enumerate(ladder_ratings)))
+        for _ in range(20):
+            rating = random_rating(rng, ladder_ratings)
+            percentile = rng.choice((0, 0.15, 0.3, 1, rng.random()))
+            assert engine.search_range(rating, percentile) == old_search_range(ladder_ratings, rating, percentile)
+
+
+def test_updates_match_a_fresh_sort():
+    rng = random.Random(2)
+    for _ in range(100):
+        ladder_players = dict(enumerate(random_ladder(rng)))
+        engine = ratings.PercentileEngine(ladder_players)
+        follower = ratings.PercentileEngine(ladder_players)
+        next_player = len(ladder_players)
+        for _ in range(5):
+            # Some players' ratings change, some players join the ladder and some leave it, now and
+            # then with a rating outside the sentinels
+            ladder_players = {player: rating + rng.randint(-30, 30) if rng.random() < 0.1 else rating
+                              for player, rating in ladder_players.items() if rng.random() > 0.05}
+            for _ in range(rng.randint(0, 10)):
+                ladder_players[next_player] = round(rng.gauss(1500, 200)) if rng.random() < 0.95 \
+                    else rng.choice((-40, 3100))
+                next_player += 1
+            changes = engine.update(ladder_players)
+            assert engine.players == ladder_players
+            assert [engine.select(i) for i in range(len(engine))] == sorted(ladder_players.values())
+            # An engine that only gets the changes, like the engine worker process, ends up the same
+            follower.apply_changes(changes)
+            ladder_ratings = list(ladder_players.values())
+            rating = random_rating(rng, ladder_ratings)
+            percentile = rng.random()
+            assert engine.search_range(rating, percentile) == old_search_range(ladder_ratings, rating, percentile)
+            assert follower.search_range(rating, percentile) == engine.search_range(rating, percentile)
+
+
+def test_percentile_to_reach_is_where_the_range_first_includes_a_rating():
+    rng = random.Random(3)
+    for _ in range(300):
+        ladder_ratings = random_ladder(rng)
+        engine = ratings.PercentileEngine(dict(enumerate(ladder_ratings)))
+        size = len(ladder_ratings) + 3
+        for _ in range(10):
+            rating = random_rating(rng, ladder_ratings)
+            other_rating = random_rating(rng, ladder_ratings)
+            percentile = engine.percentile_to_reach(rating, other_rating)
+            if percentile is None:
+                min_rating, max_rating = engine.search_range(rating, 2)
+                assert not min_rating <= other_rating <= max_rating
+                continue
+            step = 0.01 / size
+            min_rating, max_rating = engine.search_range(rating, percentile + step)
+            assert min_rating <= other_rating <= max_rating
+            if percentile > 0:
+                min_rating, max_rating = engine.search_range(rating, percentile - step)
+                assert not min_rating <= other_rating <= max_rating
+
+
+def test_stars_players_keeps_every_rating():
+    ladder_players = ratings.stars_players(["Alice", "Bob", "", "Alice"], ["1500", "1400", "1300", "1600", "", "1200"])
+    assert ladder_players == {"Alice": 1500, "Bob": 1400, "(row 4)": 1300, "Alice (row 5)": 1600,
+                              "(row 7)": 1200}